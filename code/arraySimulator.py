@@ -0,0 +1,172 @@
+from trafficSimulator import TrafficSimulator
+import itertools
+import numpy as np
+
+
+class ArrayTrafficSimulator(TrafficSimulator):
+    """
+    The same simulation as TrafficSimulator, with the state of all cars in numpy arrays instead of DualGraphCar
+    objects, so that a tick is a handful of vectorized operations.
+
+    Streets are self.city_roads.csr indices. Car i is on street buffer[offset[i] + position[i]], where its
+    itinerary is the length[i] streets from offset[i] in one flat buffer shared by all cars.
+
+    Every car moves on the street counts of the start of the tick, where the object engine lets each car see the
+    moves of the cars before it. The speeds and the per street counts they lead to follow the same distribution.
+    The route cache, if any, holds street nids like the object engine's, so that both can share a cache file.
+
+    car_counts, a numpy array here, is kept up to date by street nid as in TrafficSimulator, so traffic_coefficient
+    answers for a single street too. Cars move in tick only; there is no move_car.
+    """
+
+    def __init__(self, dual_graph, num_cars, router="alt", cache_size=None, cache_file=None, seed=None):
+        """
+        :param seed: seed of the random numbers the simulation draws.
+        """
+        self.rng = np.random.RandomState(seed)
+        super(ArrayTrafficSimulator, self).__init__(dual_graph, num_cars, router, cache_size, cache_file)
+
+    def setup_simulation(self, N):
+        """
+        Initialize the simulation.
+        :param N: # of cars
+        :return: None
+        """
+        csr = self.city_roads.csr
+        self.cars = []
+        self._streets = csr.GetNodes()
+        self._weights = np.array([self.city_roads.street_weights[nid] for nid in csr.idList()], dtype=np.float64)
+        self._endpoints = np.array([csr.index[nid] for nid in self.possible_endpoints], dtype=np.int64)
+        self._router = self.city_roads.router(self.router)
+        # csr index of every street nid, to read the nids of cached routes back, and the other way around
+        self._ids = csr.idList()
+        self._nids = csr.nodeIds.astype(np.int64)
+        self._indices = np.zeros(int(csr.nodeIds.max()) + 1, dtype=np.int64)
+        self._indices[csr.nodeIds] = np.arange(self._streets)
+        # the object engine's coefficient table isn't kept; traffic_coefficient works from car_counts
+        self.street_coefficients = None
+
+        self.offset = np.zeros(N, dtype=np.int64)
+        self.length = np.zeros(N, dtype=np.int64)
+        self.position = np.zeros(N, dtype=np.int64)
+        self.progress = np.zeros(N)
+        self.completed_trips = np.zeros(N, dtype=np.int64)
+
+        self._buffer = np.empty(0, dtype=np.int64)
+        self._used = 0
+        self._new_trips(np.arange(N))
+        self._count_cars()
+
+    def _route(self, start, stop):
+        """
+        :param start: csr index of the street the trip starts on.
+        :param stop: csr index of the street it ends on.
+        :return: the itinerary, as street nids.
+        """
+        def compute():
+            path = self._router.path(start, stop)
+            return [self._ids[i] for i in path] if path is not None else [None]
+
+        if self.route_cache is None:
+            return compute()
+        return self.route_cache.get(self._ids[start], self._ids[stop], compute)
+
+    def _new_trips(self, cars):
+        """
+        Send every car in cars from the start of a new random trip.
+        """
+        starts = self._endpoints[self.rng.randint(len(self._endpoints), size=len(cars))]
+        stops = self._endpoints[self.rng.randint(len(self._endpoints), size=len(cars))]
+        same = np.flatnonzero(starts == stops)
+        while len(same):
+            stops[same] = self._endpoints[self.rng.randint(len(self._endpoints), size=len(same))]
+            same = same[starts[same] == stops[same]]
+
+        routes = [self._route(start, stop) for start, stop in zip(starts.tolist(), stops.tolist())]
+        lengths = np.array([len(route) for route in routes], dtype=np.int64)
+        total = int(lengths.sum())
+
+        self._reserve(total)
+        self.offset[cars] = self._used + np.cumsum(lengths) - lengths
+        self.length[cars] = lengths
+        self.position[cars] = 0
+        self._buffer[self._used:self._used + total] = \
+            self._indices[np.fromiter(itertools.chain.from_iterable(routes), dtype=np.int64, count=total)]
+        self._used += total
+
+    def _reserve(self, extra):
+        """
+        Make room for extra more streets at the end of the itinerary buffer, first by dropping the itineraries no
+        car is on anymore, then by growing it.
+        """
+        if self._used + extra <= len(self._buffer):
+            return
+
+        live = int(self.length.sum())
+        ranges = np.repeat(self.offset - np.cumsum(self.length) + self.length, self.length) + np.arange(live)
+        size = max(2 * (live + extra), len(self._buffer))
+        buffer = np.empty(size, dtype=np.int64)
+        buffer[:live] = self._buffer[ranges]
+
+        self._buffer = buffer
+        self.offset = np.cumsum(self.length) - self.length
+        self._used = live
+
+    def _count_cars(self):
+        """
+        Recount car_counts. A bincount over all streets is cheaper than updating the counts of the cars that moved
+        one by one with np.add.at.
+        """
+        self.car_counts = np.bincount(self._nids[self.current_streets()], minlength=len(self.street_weights))
+
+    def current_streets(self):
+        """
+        :return: the street every car is on.
+        """
+        return self._buffer[self.offset + self.position]
+
+    def traffic_coefficient(self, street_nid):
+        """
+        traffic_coefficient of TrafficSimulator, from car_counts.
+        """
+        return self.street_decay[street_nid] ** (self.car_counts[street_nid] - 1)
+
+    def move_car(self, from_street, to_street):
+        raise NotImplementedError("ArrayTrafficSimulator moves its cars in tick")
+
+    def traffic_coefficients(self, streets, counts):
+        """
+        traffic_coefficient of TrafficSimulator for every street in streets at once.
+        :param streets: csr indices of the streets.
+        :param counts: # cars on each of them.
+        """
+        weights = self._weights[streets]
+        return np.power(0.25, (counts - 1.0) / weights)
+
+    def tick(self):
+        streets = self.current_streets()
+        nids = self._nids[streets]
+        weights = self._weights[streets]
+
+        increment = 1.0 / (8 + 4 * self.rng.random_sample(len(streets))) \
+                        * self.traffic_coefficients(streets, self.car_counts[nids]) * weights
+        np.clip(increment, self.BASE_SPEED, self.TOP_SPEED, out=increment)
+        self.progress += increment
+
+        # Move on to the next street in the itinerary, and start a new trip at the end of it.
+        moved = np.flatnonzero(self.progress >= weights)
+        self.progress[moved] = 0.0
+        self.position[moved] += 1
+
+        finished = moved[self.position[moved] == self.length[moved] - 1]
+        if len(finished):
+            self.completed_trips[finished] += 1
+            self._new_trips(finished)
+
+        self._count_cars()
+
+    def street_histogram(self):
+        """
+        :return: # cars on every street, by street nid
+        """
+        return self.car_counts.copy()
@@ -0,0 +1,264 @@
+import numpy as np
+import heapq
+import os
+import osmParser
+
+# contraction hierarchy files next to a city's data files
+CONTRACTION_EXTENSION = ".ch"
+
+# witness searches give up after settling this many nodes, which only costs an unneeded shortcut now and then
+WITNESS_SETTLE_LIMIT = 64
+
+INFINITY = float("inf")
+
+"""
+Contraction hierarchy over a weighted, undirected CSRGraph.
+
+Nodes are contracted one at a time, least important first. Contracting v removes it and adds a shortcut u-w for
+every pair of its remaining neighbours whose shortest path goes through v, so distances between the remaining
+nodes don't change. A query then only ever goes up in the order, from both ends, and meets at the top.
+
+Since the graph is undirected one upward graph serves both directions: node v's upward arcs go to the neighbours
+it still had when it was contracted, and middle[k] is the node a shortcut arc skips, -1 for an original arc.
+"""
+class ContractionHierarchy(object):
+
+	def __init__(self, nodeIds, rank, indptr, indices, weights, middle):
+		self.nodeIds = nodeIds
+		self.rank = rank
+		self.indptr = indptr
+		self.indices = indices
+		self.weights = weights
+		self.middle = middle
+
+		self._lists = None
+		self._shortcuts = None
+
+		# nodes settled by the last query, for benchmarks
+		self.expanded = 0
+
+	def lists(self):
+		"""
+		The upward graph as python lists (indptr, indices, weights), cached.
+		"""
+		if self._lists is None:
+			self._lists = (self.indptr.tolist(), self.indices.tolist(), self.weights.tolist())
+		return self._lists
+
+	@property
+	def shortcuts(self):
+		"""
+		Map from a shortcut's (lower, higher) end indices to the node it skips.
+		"""
+		if self._shortcuts is None:
+			src = np.repeat(np.arange(len(self.nodeIds)), np.diff(self.indptr))
+			isShortcut = self.middle >= 0
+			ends = zip(np.minimum(src, self.indices)[isShortcut].tolist(), np.maximum(src, self.indices)[isShortcut].tolist())
+			self._shortcuts = dict(zip(ends, self.middle[isShortcut].tolist()))
+		return self._shortcuts
+
+	def _upward(self, dist, parent, heap, other, best, meet):
+		"""
+		Settle one node of a search direction. other is the opposite direction's distances. Returns the best
+		meeting distance and node so far.
+		"""
+		indptr, indices, weights = self.lists()
+		d, v = heapq.heappop(heap)
+		if d > dist[v]:
+			return best, meet
+
+		# stall on demand: a higher neighbour already reached v for less, so v is not on a shortest up-path
+		for k in xrange(indptr[v], indptr[v + 1]):
+			w = indices[k]
+			if dist.get(w, INFINITY) + weights[k] < d:
+				return best, meet
+
+		self.expanded += 1
+		if v in other and d + other[v] < best:
+			best, meet = d + other[v], v
+
+		for k in xrange(indptr[v], indptr[v + 1]):
+			w = indices[k]
+			nd = d + weights[k]
+			if nd < dist.get(w, INFINITY):
+				dist[w] = nd
+				parent[w] = v
+				heapq.heappush(heap, (nd, w))
+
+		return best, meet
+
+	def path(self, source, target):
+		"""
+		Indices of a shortest path from index source to index target, both included, or None if there is none.
+		"""
+		forward, backward = {source: 0}, {target: 0}
+		forwardParent, backwardParent = {}, {}
+		forwardHeap, backwardHeap = [(0, source)], [(0, target)]
+		best, meet = INFINITY, None
+		self.expanded = 0
+
+		while forwardHeap or backwardHeap:
+			if forwardHeap and forwardHeap[0][0] >= best:
+				forwardHeap = []
+			if backwardHeap and backwardHeap[0][0] >= best:
+				backwardHeap = []
+			if forwardHeap:
+				best, meet = self._upward(forward, forwardParent, forwardHeap, backward, best, meet)
+			if backwardHeap:
+				best, meet = self._upward(backward, backwardParent, backwardHeap, forward, best, meet)
+
+		if meet is None:
+			return None
+
+		up = [meet]
+		while up[-1] != source:
+			up.append(forwardParent[up[-1]])
+		up.reverse()
+		while up[-1] != target:
+			up.append(backwardParent[up[-1]])
+
+		return self._unpack(up)
+
+	def _unpack(self, path):
+		"""
+		Replace every shortcut along path by the nodes it skips.
+		"""
+		shortcuts = self.shortcuts
+		result = [path[0]]
+		stack = []
+		for v in path[1:]:
+			stack.append(v)
+			while stack:
+				u, w = result[-1], stack[-1]
+				middle = shortcuts.get((u, w) if u < w else (w, u))
+				if middle is None:
+					result.append(stack.pop())
+				else:
+					stack.append(middle)
+		return result
+
+def _witness(adjacency, source, avoid, targets, limit):
+	"""
+	Distances from source to targets, as far as a search that skips avoid, stops past limit and settles at most
+	WITNESS_SETTLE_LIMIT nodes finds them.
+	"""
+	dist = {source: 0}
+	found = {}
+	heap = [(0, source)]
+	settled = 0
+	remaining = len(targets)
+
+	while heap and settled < WITNESS_SETTLE_LIMIT and remaining:
+		d, v = heapq.heappop(heap)
+		if d > dist[v]:
+			continue
+		if d > limit:
+			break
+		settled += 1
+		if v in targets and v not in found:
+			found[v] = d
+			remaining -= 1
+
+		for w, weight in adjacency[v].iteritems():
+			if w == avoid:
+				continue
+			nd = d + weight
+			if nd < dist.get(w, INFINITY):
+				dist[w] = nd
+				heapq.heappush(heap, (nd, w))
+
+	return found
+
+def _shortcuts(adjacency, v):
+	"""
+	The shortcuts (u, w, weight) that contracting v needs, each pair once.
+	"""
+	neighbours = adjacency[v].items()
+	needed = []
+	for i, (u, uWeight) in enumerate(neighbours):
+		others = neighbours[i + 1:]
+		if not others:
+			break
+		limit = uWeight + max(weight for _, weight in others)
+		found = _witness(adjacency, u, v, set(w for w, _ in others), limit)
+		for w, wWeight in others:
+			if found.get(w, INFINITY) > uWeight + wWeight:
+				needed.append((u, w, uWeight + wWeight))
+	return needed
+
+def _priority(adjacency, v, deleted):
+	# edge difference, plus how many neighbours are already gone so that contraction spreads over the graph
+	return len(_shortcuts(adjacency, v)) - len(adjacency[v]) + deleted[v]
+
+def build(graph):
+	"""
+	Contract every node of graph (a CSRGraph with weights) by lazily updated edge difference.
+	"""
+	n = graph.GetNodes()
+	indptr, indices, weights = graph.lists()
+
+	adjacency = [{} for _ in xrange(n)]
+	for v in xrange(n):
+		for k in xrange(indptr[v], indptr[v + 1]):
+			w = indices[k]
+			if w != v and weights[k] < adjacency[v].get(w, INFINITY):
+				adjacency[v][w] = weights[k]
+
+	middles = {}
+	deleted = [0] * n
+	heap = [(_priority(adjacency, v, deleted), v) for v in xrange(n)]
+	heapq.heapify(heap)
+
+	rank = np.empty(n, dtype=np.int64)
+	upward = [None] * n
+	contracted = 0
+	while heap:
+		_, v = heapq.heappop(heap)
+		priority = _priority(adjacency, v, deleted)
+		if heap and priority > heap[0][0]:
+			heapq.heappush(heap, (priority, v))
+			continue
+
+		for u, w, weight in _shortcuts(adjacency, v):
+			if weight < adjacency[u].get(w, INFINITY):
+				adjacency[u][w] = adjacency[w][u] = weight
+				middles[(u, w) if u < w else (w, u)] = v
+
+		rank[v] = contracted
+		contracted += 1
+		upward[v] = adjacency[v]
+		for u in adjacency[v]:
+			del adjacency[u][v]
+			deleted[u] += 1
+		adjacency[v] = {}
+
+	counts = np.array([len(arcs) for arcs in upward], dtype=np.int64)
+	upIndptr = np.zeros(n + 1, dtype=np.int64)
+	np.cumsum(counts, out=upIndptr[1:])
+	upIndices = np.array([w for arcs in upward for w in arcs], dtype=np.int64)
+	upWeights = np.array([weight for arcs in upward for weight in arcs.itervalues()], dtype=np.float64)
+	upMiddle = np.array([middles.get((u, w) if u < w else (w, u), -1) for u, arcs in enumerate(upward) for w in arcs],
+						dtype=np.int64)
+
+	return ContractionHierarchy(graph.nodeIds, rank, upIndptr, upIndices, upWeights, upMiddle)
+
+def load(name, graph):
+	"""
+	The contraction hierarchy of a city, read from its .ch file if it was made for the same graph (see
+	CSRGraph.digest), otherwise built and written to it.
+	"""
+	path = osmParser.DATA_PATH + name + CONTRACTION_EXTENSION
+	digest = graph.digest()
+	if os.path.isfile(path):
+		saved = np.load(path)
+		if 'digest' in saved.files and str(saved['digest']) == digest:
+			return ContractionHierarchy(saved['nodeIds'], saved['rank'], saved['indptr'], saved['indices'],
+										saved['weights'], saved['middle'])
+
+	result = build(graph)
+	temporary = path + ".tmp"
+	with open(temporary, 'wb') as out:
+		np.savez(out, nodeIds=result.nodeIds, rank=result.rank, indptr=result.indptr, indices=result.indices,
+				 weights=result.weights, middle=result.middle, digest=np.array(digest))
+	os.rename(temporary, path)
+	return result
@@ -0,0 +1,340 @@
+import numpy as np
+import hashlib
+import heapq
+import os
+import osmParser
+import geometry
+
+INFINITY = float("inf")
+
+# edge length files next to a city's .csr: a header with the digest of the graph (see CSRGraph.digest), then one
+# float64 per arc
+EDGE_LENGTH_EXTENSIONS = {"degrees": ".dlen", "metres": ".mlen", "hops": ".hlen"}
+EDGE_LENGTH_MAGIC = "USWLEN01"
+EDGE_LENGTH_HEADER_SIZE = 64
+
+"""
+A read-only undirected graph stored as flat arrays instead of a snap graph, so that traversals don't cross
+into snap for every neighbor they look at.
+
+Nodes are dense indices 0..n-1. nodeIds[i] is the original (snap) node id of index i, and the neighbors of i are
+indices[indptr[i]:indptr[i+1]]. weights, when set, is aligned with indices (one value per arc), and metric says
+what they measure.
+"""
+class CSRGraph(object):
+
+	def __init__(self, nodeIds, indptr, indices, coords=None, weights=None):
+		self.nodeIds = nodeIds
+		self.indptr = indptr
+		self.indices = indices
+		self.coords = coords
+		self.weights = weights
+		self.metric = None
+
+		self._index = None
+		self._lists = None
+		self._ids = None
+		self._edgeIds = None
+
+	def GetNodes(self):
+		return len(self.nodeIds)
+
+	@property
+	def index(self):
+		"""
+		Map from original node id to dense index.
+		"""
+		if self._index is None:
+			self._index = dict(zip(self.idList(), xrange(len(self.nodeIds))))
+		return self._index
+
+	def lists(self):
+		"""
+		The arrays as plain python lists (indptr, indices, weights), cached. Indexing a list from python code is
+		much faster than indexing a numpy array, so pure python traversals should loop over these.
+		"""
+		if self._lists is None:
+			weights = self.weights.tolist() if self.weights is not None else None
+			self._lists = (self.indptr.tolist(), self.indices.tolist(), weights)
+		return self._lists
+
+	def setEdgeLengths(self, metric="degrees", weights=None):
+		"""
+		Use the geometric length of every edge as its weight, computed from coords unless weights is given.
+		"""
+		if weights is None:
+			weights = edgeLengths(self.coords, self.indptr, self.indices, metric)
+		self.weights = weights
+		self.metric = metric
+		self._lists = None
+
+	def digest(self):
+		"""
+		sha1 (hex) of the node ids, arcs and weights, to tell whether tables saved for a graph still fit it.
+		"""
+		digest = hashlib.sha1()
+		for array, dtype in [(self.nodeIds, np.int64), (self.indptr, np.int64), (self.indices, np.int64),
+							 (self.weights, np.float64)]:
+			if array is not None:
+				digest.update(np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder('<')).tobytes())
+		return digest.hexdigest()
+
+	def idList(self):
+		"""
+		nodeIds as a python list, cached.
+		"""
+		if self._ids is None:
+			self._ids = self.nodeIds.tolist()
+		return self._ids
+
+	def coordList(self):
+		"""
+		(lat, lon) of every index as a list, usable wherever a nodesMap is expected but keyed by index.
+		"""
+		return [tuple(c) for c in self.coords.tolist()]
+
+def fromSnap(G, nodesMap=None):
+	"""
+	Build a CSRGraph from an undirected snap graph. nodesMap (node id to (lat, lon)) is optional.
+	"""
+	nodeIds, coords, indptr, indices = osmParser.graphToArrays(G, nodesMap)
+	return CSRGraph(nodeIds, indptr, indices, coords)
+
+def load(name, metric=None):
+	"""
+	Load a city from its .csr file (see osmParser.convertToArrays). The arrays are memory maps.
+	With a metric, edge lengths are read from the city's length file, which is written the first time and again
+	whenever it was made for another graph.
+	"""
+	nodeIds, coords, indptr, indices = osmParser.loadArraysFromFile(name)
+	graph = CSRGraph(nodeIds, indptr, indices, coords)
+
+	if metric is not None:
+		path = osmParser.DATA_PATH + name + EDGE_LENGTH_EXTENSIONS[metric]
+		weights = _loadEdgeLengths(path, graph)
+		if weights is not None:
+			graph.setEdgeLengths(metric, weights)
+		else:
+			header = (EDGE_LENGTH_MAGIC + graph.digest()).ljust(EDGE_LENGTH_HEADER_SIZE, "\0")
+			graph.setEdgeLengths(metric)
+			temporary = path + ".tmp"
+			with open(temporary, 'wb') as out:
+				out.write(header)
+				graph.weights.astype('<f8').tofile(out)
+			os.rename(temporary, path)
+
+	return graph
+
+def _loadEdgeLengths(path, graph):
+	"""
+	The edge lengths in path as a memory map, or None if there is no such file or it doesn't fit graph.
+	"""
+	if not os.path.isfile(path):
+		return None
+	with open(path, 'rb') as source:
+		header = source.read(EDGE_LENGTH_HEADER_SIZE)
+	if header != (EDGE_LENGTH_MAGIC + graph.digest()).ljust(EDGE_LENGTH_HEADER_SIZE, "\0"):
+		return None
+	if os.path.getsize(path) != EDGE_LENGTH_HEADER_SIZE + 8 * len(graph.indices):
+		return None
+	return np.memmap(path, dtype='<f8', mode='r', offset=EDGE_LENGTH_HEADER_SIZE)
+
+def asCSR(graph, nodesMap=None):
+	"""
+	Lets functions take either a snap graph or a CSRGraph.
+	"""
+	if isinstance(graph, CSRGraph):
+		return graph
+	return fromSnap(graph, nodesMap)
+
+def edgeLengths(coords, indptr, indices, metric="degrees"):
+	"""
+	Length of every arc in one vectorized pass. "degrees" is the plain euclidean norm of (lat, lon), "metres" the
+	haversine distance and "hops" is 1 for every edge.
+	"""
+	if metric == "hops":
+		return np.ones(len(indices))
+
+	src = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+	c1 = coords[src]
+	c2 = coords[indices]
+
+	if metric == "degrees":
+		return np.sqrt(geometry.rowSquaredDistances(c1, c2))
+	elif metric == "metres":
+		return geometry.haversine(c1, c2)
+	raise ValueError("unknown metric " + metric)
+
+def edgeIds(graph):
+	"""
+	Number the undirected edges of graph. Returns, for every arc, the id of its edge, and an (m, 2) array of the
+	(smaller, larger) end indices of every edge. Cached on the graph.
+	"""
+	if graph._edgeIds is None:
+		n = graph.GetNodes()
+		src = np.repeat(np.arange(n, dtype=np.int64), np.diff(graph.indptr))
+		dst = np.asarray(graph.indices, dtype=np.int64)
+		keys = np.minimum(src, dst) * n + np.maximum(src, dst)
+
+		unique, arcEdge = np.unique(keys, return_inverse=True)
+		graph._edgeIds = (arcEdge, np.column_stack((unique // n, unique % n)))
+	return graph._edgeIds
+
+def multiSourceBFS(graph, sources):
+	"""
+	Breadth first searches from every index in sources at once. Each node keeps one bit per source. A level only
+	looks at the frontier: every frontier node pushes its new bits along its arcs, the bits are ORed per target and
+	whatever a target had already seen is dropped. Sources close to each other reach a node within a few levels of
+	each other, so a node is on the frontier for few levels even when the searches run for thousands.
+
+	Returns, per node, the sum of hop distances from the sources that reach it and the number of such sources. In
+	an undirected graph that is the node's own distance sum to those sources.
+	"""
+	n = graph.GetNodes()
+	indptr = np.asarray(graph.indptr)
+	indices = np.asarray(graph.indices)
+	sources = np.asarray(sources, dtype=np.int64)
+	words = (len(sources) + 63) // 64
+	positions = np.arange(len(sources))
+
+	visited = np.zeros((n, words), dtype=np.uint64)
+	visited[sources, positions // 64] = np.left_shift(np.uint64(1), (positions % 64).astype(np.uint64))
+	active = np.unique(sources)
+	activeBits = visited[active]
+
+	farness = np.zeros(n, dtype=np.int64)
+	reached = _popcount(visited)
+	level = 0
+	while len(active):
+		level += 1
+		starts = indptr[active]
+		degrees = indptr[active + 1] - starts
+		arcs = np.repeat(starts - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+
+		targets = indices[arcs]
+		order = np.argsort(targets, kind='mergesort')
+		targets = targets[order]
+		segments = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+		bits = np.bitwise_or.reduceat(np.repeat(activeBits, degrees, axis=0)[order], segments, axis=0)
+		targets = targets[segments]
+
+		bits &= ~visited[targets]
+		new = bits.any(axis=1)
+		active = targets[new]
+		activeBits = bits[new]
+
+		visited[active] |= activeBits
+		counts = _popcount(activeBits)
+		farness[active] += level * counts
+		reached[active] += counts
+
+	return farness, reached
+
+_M1, _M2, _M4 = np.uint64(0x5555555555555555), np.uint64(0x3333333333333333), np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+# number of set bits in every row of a (n, words) uint64 array, by the usual shift and mask steps on whole words
+def _popcount(bits):
+	x = bits - ((bits >> np.uint64(1)) & _M1)
+	x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+	x = (x + (x >> np.uint64(4))) & _M4
+	return ((x * _H01) >> np.uint64(56)).astype(np.int64).sum(axis=1)
+
+def dijkstra(graph, source, maxNodes=None, radius=None, targets=None):
+	"""
+	Single source shortest paths over graph.weights, from index source. Returns a map from every settled index to
+	its distance. A node is only pushed when its tentative distance improves, and stale heap entries are skipped.
+
+	Stops early once maxNodes nodes are settled, once the next node is farther than radius, or once every index in
+	targets is settled, whichever comes first.
+	"""
+	indptr, indices, weights = graph.lists()
+	tentative = {source: 0.0}
+	settled = {}
+	heap = [(0.0, source)]
+	if targets is not None:
+		targets = set(targets)
+		remaining = len(targets)
+
+	while heap:
+		d, v = heapq.heappop(heap)
+		if v in settled or d > tentative[v]:
+			continue
+		if radius is not None and d > radius:
+			break
+
+		settled[v] = d
+		if maxNodes is not None and len(settled) >= maxNodes:
+			break
+		if targets is not None and v in targets:
+			remaining -= 1
+			if remaining == 0:
+				break
+
+		for k in xrange(indptr[v], indptr[v + 1]):
+			w = indices[k]
+			if w in settled:
+				continue
+			nd = d + weights[k]
+			if nd < tentative.get(w, INFINITY):
+				tentative[w] = nd
+				heapq.heappush(heap, (nd, w))
+
+	return settled
+
+class BoundedSearch(object):
+	"""
+	Dijkstra for many small searches on one graph. The distance and settled arrays and the heap are allocated once
+	and only the entries a search touched are reset, so a search costs what it explores, not the size of the graph.
+	"""
+
+	def __init__(self, graph):
+		self.graph = graph
+		n = graph.GetNodes()
+		self.dist = [INFINITY] * n
+		self.settled = [False] * n
+		self.touched = []
+		self.heap = []
+
+	def run(self, source, maxNodes=None, radius=None):
+		"""
+		Distances of the nodes settled from index source, in settling order. Same stopping rules as dijkstra.
+		"""
+		indptr, indices, weights = self.graph.lists()
+		dist, settled, touched, heap = self.dist, self.settled, self.touched, self.heap
+
+		for v in touched:
+			dist[v] = INFINITY
+			settled[v] = False
+		del touched[:]
+		del heap[:]
+
+		distances = []
+		dist[source] = 0.0
+		touched.append(source)
+		heap.append((0.0, source))
+
+		while heap:
+			d, v = heapq.heappop(heap)
+			if settled[v] or d > dist[v]:
+				continue
+			if radius is not None and d > radius:
+				break
+
+			settled[v] = True
+			distances.append(d)
+			if maxNodes is not None and len(distances) >= maxNodes:
+				break
+
+			for k in xrange(indptr[v], indptr[v + 1]):
+				w = indices[k]
+				if settled[w]:
+					continue
+				nd = d + weights[k]
+				if nd < dist[w]:
+					if dist[w] == INFINITY:
+						touched.append(w)
+					dist[w] = nd
+					heapq.heappush(heap, (nd, w))
+
+		return distances
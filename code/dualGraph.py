@@ -1,7 +1,23 @@
 import snap
 import osmParser as osmParser
-from osmParser import simpleLoadFromFile
-import math
+import csrGraph
+import geometry
+import landmarks
+import contraction
+import numpy as np
+import hashlib
+import os
+import struct
+
+# routing backends, see DualGraph.router
+ROUTERS = ("alt", "ch")
+
+# .dual files: a 64 byte header (magic and format version, sha1 of the city's source files, street, arc and endpoint
+# counts) followed by contiguous little-endian arrays, like .csr files. Bump the version when the layout or the
+# way the dual graph is built changes, and old files are rebuilt.
+DUAL_MAGIC = "USWDUAL1"
+DUAL_HEADER = "<8s20sqqq"
+DUAL_HEADER_SIZE = 64
 
 class DualGraph(object):
     """
@@ -11,113 +27,212 @@ class DualGraph(object):
     """
 
 
-    def __init__(self, name):
-
-        graph, self.nid_to_coords = osmParser.simpleLoadFromFile(name)
-
-        # For getting a new node id to set an edge to.
-        self.NID_GENERATOR = 0
+    def __init__(self, name, cache=True):
+        """
+        :param name: city name.
+        :param cache: read the dual graph from the city's .dual file when it was built from the same source files,
+        and write it there otherwise.
+        """
+        self.name = name
+        arrays = load_dual(name) if cache else None
+        if arrays is None:
+            primal = self._load_primal(name)
+            arrays = dual_arrays(primal.coords, primal.indptr, primal.indices)
+            arrays += (median_endpoints(arrays[1]),)
+            if cache:
+                save_dual(name, *arrays)
+        coordinates, weights, indptr, indices, endpoints = arrays
+
+        # Streets short enough to start and end trips on (see median_endpoints).
+        self.possible_endpoints = endpoints.tolist()
+
+        # Streets are numbered from 1, in the order snap lists the primal edges.
+        nids = np.arange(1, len(weights) + 1, dtype=np.int32)
 
         # An integer representing the baseline # of time steps it takes to cross this street. Each indiv. car's time
         # may vary by a factor of 0.75 to 1.25.
-        self.street_weights = {}
+        self.street_weights = dict(zip(nids.tolist(), weights.tolist()))
 
         # The average coordinates for each street (node). Average the lon lat of this street's endpoints.
         # Used for heuristics in A* search.
-        self.street_coordinates = {}
+        self.street_coordinates = dict(zip(nids.tolist(), [tuple(c) for c in coordinates.tolist()]))
 
-        # Keep track of which edges in the snap_graph are which nodes in the dual graph. Discarded after initialization.
-        self._names = {}
+        # The dual graph as flat arrays, for traversals. Coordinates are the street coordinates.
+        self.csr = csrGraph.CSRGraph(nids, indptr, indices, coordinates)
+        self.csr.setEdgeLengths("streets", self._arc_weights(weights))
 
-        # An instance of PUNGraph from snap.
-        self.graph = self._create_dual_representation(graph)
+        # The same graph as a snap graph, built on first use.
+        self._graph = None
 
+        # Landmark tables and contraction hierarchy for routing, built or read from disk on first use.
+        self._landmarks = None
+        self._contraction = None
 
-
-    def _get_nid(self):
+    @staticmethod
+    def _load_primal(name):
         """
-        :return: the next integer we havent used for nids.
+        :return: the road network as a CSRGraph with coordinates, from the city's .csr file if it has one.
         """
-        self.NID_GENERATOR += 1
-        return self.NID_GENERATOR
-
+        if os.path.isfile(osmParser.DATA_PATH + name + ".csr"):
+            return csrGraph.load(name)
+        return csrGraph.fromSnap(*osmParser.simpleLoadFromFile(name))
 
-    @staticmethod
-    def _norm_edge(n1, n2):
+    @property
+    def graph(self):
         """
-        :param n1: first node id
-        :param n2: second node id
-        :return: ordered edge (a, b) with b >= a
+        :return: the dual graph as an undirected snap graph.
         """
-        return (n1, n2) if n2 > n1 else (n2, n1)
-
-    @staticmethod
-    def _distance(c1, c2):
+        if self._graph is None:
+            graph = snap.TUNGraph.New()
+            for nid in self.csr.idList():
+                graph.AddNode(nid)
+            src = np.repeat(self.csr.nodeIds, np.diff(self.csr.indptr))
+            dst = self.csr.nodeIds[self.csr.indices]
+            for n1, n2 in zip(src[src < dst].tolist(), dst[src < dst].tolist()):
+                graph.AddEdge(n1, n2)
+            self._graph = graph
+        return self._graph
+
+    @property
+    def landmarks(self):
         """
-        L2 norm.
+        :return: the landmarks.Landmarks of this city over self.csr.
         """
-        return math.sqrt((c1[0]-c2[0])**2 + (c1[1]-c2[1])**2)
+        if self._landmarks is None:
+            self._landmarks = landmarks.load(self.name, self.csr)
+        return self._landmarks
 
-    def _create_all_pairwise_edges(self, dual_nodes, graph):
+    @property
+    def contraction(self):
         """
-        Create edges from every node in dual_nodes to every other node in it.
-        :param dual_nodes: list of nids
-        :param graph: a snap graph
+        :return: the contraction.ContractionHierarchy of this city over self.csr.
         """
-        length = len(dual_nodes)
-        for i in xrange(length):
-            for j in xrange(i+1, length):
-                n1 = dual_nodes[i]
-                n2 = dual_nodes[j]
-                e1 = n1 if n1 < n2 else n2
-                e2 = n1+n2 - e1
+        if self._contraction is None:
+            self._contraction = contraction.load(self.name, self.csr)
+        return self._contraction
 
-                graph.AddEdge(e1, e2)
-
-
-    def _create_dual_representation(self, snap_graph):
+    def router(self, kind):
+        """
+        :param kind: one of ROUTERS, "alt" for landmark A* or "ch" for the contraction hierarchy.
+        :return: an object whose path(source, target) gives the shortest route between two self.csr indices.
         """
-        Takes in a traditional SNAP graph of a road network, and creates an instance of DualGraph that is the dual
-         representation of that same road network.
-        self._weights is also modified to have all the edge weights during this function.
+        if kind not in ROUTERS:
+            raise ValueError("unknown router %s, expected one of %s" % (kind, ", ".join(ROUTERS)))
+        return self.landmarks if kind == "alt" else self.contraction
 
-        :param snap_graph: a undirected snap graph.
-        :return: another undirected snap graph, transformed to dual.
+    def _arc_weights(self, weights):
         """
-        graph = snap.TUNGraph.New()
+        A car pays the weight of every street it leaves, so a route costs the sum of the weights of all its streets
+        but the last. Arc u-v weighs street_weights[u] + street_weights[v] instead, which is symmetric: a route then
+        costs twice its car cost, minus the first street's weight, plus the last one's. For a given start and stop
+        that is the same shortest route.
+        :param weights: street weight of every csr index.
+        :return: array of arc weights aligned with self.csr.indices
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        src = np.repeat(np.arange(self.csr.GetNodes()), np.diff(self.csr.indptr))
+        return weights[src] + weights[self.csr.indices]
 
-        for edge in snap_graph.Edges():
-            nid = self._get_nid()
-            edge = self._norm_edge(edge.GetSrcNId(), edge.GetDstNId())
-            self._names[edge] = nid
-            graph.AddNode(nid)
 
-            # register metadata in weights and coordinates: lat, lon
-            c1 = self.nid_to_coords[edge[0]]
-            c2 = self.nid_to_coords[edge[1]]
-            nid_coordinate = ((c1[0] + c2[0]) / 2, (c1[1] + c2[1]) / 2)
-            self.street_coordinates[nid] = nid_coordinate
-            self.street_weights[nid] = int(100000 * self._distance(c1, c2))
+def dual_arrays(coords, indptr, indices):
+    """
+    Build the dual of a road network given as CSR arrays, in bulk.
+    Street i is the i-th primal edge in (smaller end, larger end) order, which is the order snap lists them in. Its
+    coordinates are the midpoint of its ends and its weight is int(100000 * length), at least 1. Two streets are
+    joined when they meet at an intersection, so every intersection of degree d adds the d(d-1)/2 pairs of its streets.
+
+    :param coords: (lat, lon) of every primal node.
+    :param indptr: primal CSR offsets.
+    :param indices: primal CSR neighbours.
+    :return: street coordinates, street weights, and the dual graph's CSR indptr and indices
+    """
+    n = len(indptr) - 1
+    indptr = np.asarray(indptr, dtype=np.int64)
+    src = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))
+    dst = np.asarray(indices, dtype=np.int64)
+
+    # the street of every arc
+    keys = np.minimum(src, dst) * n + np.maximum(src, dst)
+    ends, street = np.unique(keys, return_inverse=True)
+    c1, c2 = coords[ends // n], coords[ends % n]
+    coordinates = geometry.midpoints(c1, c2)
+    weights = np.maximum((100000 * np.sqrt(geometry.rowSquaredDistances(c1, c2))).astype(np.int64), 1)
+
+    # every pair (first, second) of arcs out of the same intersection, first before second
+    degree = np.diff(indptr)
+    after = degree[src] - (np.arange(len(dst)) - indptr[src]) - 1
+    first = np.repeat(np.arange(len(dst)), after)
+    second = first + np.arange(after.sum()) - np.repeat(np.cumsum(after) - after, after) + 1
+
+    streets = len(ends)
+    u, v = street[first], street[second]
+    pairs = np.unique(np.concatenate((u * streets + v, v * streets + u)))
+    dual_src = pairs // streets
+    dual_indptr = np.zeros(streets + 1, dtype=np.int64)
+    np.cumsum(np.bincount(dual_src, minlength=streets), out=dual_indptr[1:])
+
+    return coordinates, weights, dual_indptr, (pairs % streets).astype(np.int32)
+
+
+def median_endpoints(weights):
+    """
+    :param weights: street weight of every street, by nid - 1.
+    :return: the nids of the streets shorter than the median street, in nid order
+    """
+    median = np.sort(weights)[len(weights) / 2]
+    return (np.flatnonzero(weights < median) + 1).astype(np.int32)
 
-            # elevate all weights truncated to 0, to 1.
-            if self.street_weights[nid] == 0: self.street_weights[nid] = 1
 
-        for intersection in snap_graph.Nodes():
-            dual_nodes = []
-            deg = intersection.GetOutDeg()
+def source_digest(name):
+    """
+    :return: sha1 of the files a city's dual graph is built from: .graph and .nodes, or .csr if that is all there is.
+    """
+    digest = hashlib.sha1()
+    paths = [osmParser.DATA_PATH + name + extension for extension in (".graph", ".nodes")]
+    if not all(os.path.isfile(path) for path in paths):
+        paths = [osmParser.DATA_PATH + name + ".csr"]
+    for path in paths:
+        source = open(path, 'rb')
+        for block in iter(lambda: source.read(1 << 20), ""):
+            digest.update(block)
+        source.close()
+    return digest.digest()
+
+
+def _dual_arrays(streets, arcs, endpoints):
+    """
+    :return: (dtype, shape) of the arrays of a .dual file, laid out as in .csr files (see osmParser.writeArrayFile).
+    """
+    return [(np.float64, (streets, 2)), (np.int64, (streets,)), (np.int64, (streets + 1,)), (np.int32, (arcs,)),
+            (np.int32, (endpoints,))]
 
-            if deg < 2: continue
 
-            for i in xrange(deg):
-                edge = self._norm_edge(intersection.GetId(), intersection.GetOutNId(i))
-                dual_nodes.append(self._names[edge])
+def save_dual(name, coordinates, weights, indptr, indices, endpoints):
+    """
+    Write a city's dual graph arrays to its .dual file.
+    """
+    path = osmParser.DATA_PATH + name + ".dual"
+    temporary = path + ".tmp"
+    header = struct.pack(DUAL_HEADER, DUAL_MAGIC, source_digest(name), len(weights), len(indices), len(endpoints))
+    specs = _dual_arrays(len(weights), len(indices), len(endpoints))
+    arrays = [coordinates, weights, indptr, indices, endpoints]
+    osmParser.writeArrayFile(temporary, header, DUAL_HEADER_SIZE, specs, arrays)
+    os.rename(temporary, path)
 
-            self._create_all_pairwise_edges(dual_nodes, graph)
 
-        # To remove overhead memory and speed things up. Remove these lines if they become a problem.
-        del self.nid_to_coords # old, non-dual nid to coordinates
-        del self._names
-        return graph
+def load_dual(name):
+    """
+    :return: read-only memory maps of a city's dual graph arrays (coordinates, weights, indptr, indices,
+    endpoints), or None if it has no .dual file, or one of another version or from other source files.
+    """
+    path = osmParser.DATA_PATH + name + ".dual"
+    if not os.path.isfile(path):
+        return None
+
+    magic, digest, streets, arcs, endpoints = osmParser.readArrayHeader(path, DUAL_HEADER)
+    if magic != DUAL_MAGIC or digest != source_digest(name):
+        return None
+    return osmParser.mapArrayFile(path, DUAL_HEADER_SIZE, _dual_arrays(streets, arcs, endpoints))
 
 
 if __name__ == "__main__":
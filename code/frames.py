@@ -0,0 +1,203 @@
+from collections import Counter
+import numpy as np
+import os
+import pickle
+import struct
+import sys
+
+"""
+Traffic video frames streamed to disk while a simulation runs, instead of a list of Counters pickled at the end.
+
+A .tvf file is a 64 byte file header followed by chunks. A chunk holds up to CHUNK_FRAMES frames in three columns:
+frame offsets (int64, frames + 1), street nids (int32) and car counts (int32), each frame being the streets with
+cars on them. Every chunk starts with its own header (magic, frames, entries), so a reader finds the chunks by
+skipping from header to header, and a file cut short by a crash is good up to its last whole chunk.
+"""
+
+FRAMES_MAGIC = "USWTVF01"
+FRAMES_HEADER_SIZE = 64
+CHUNK_MAGIC = "USWCHUNK"
+CHUNK_HEADER = "<8sqq"
+CHUNK_HEADER_SIZE = 24
+
+# frames buffered in memory before they are written out
+CHUNK_FRAMES = 64
+
+
+def street_counter(streets, counts, street_coordinates):
+    """
+    Attach coordinates to a street histogram, for the .tvd and .tsd files.
+    :param streets: street nids.
+    :param counts: # cars on each of them.
+    :return: a counter of how many cars are on each street coordinate.
+    """
+    picture = Counter()
+    for street, count in zip(np.asarray(streets).tolist(), np.asarray(counts).tolist()):
+        picture[street_coordinates[street]] += count
+    return picture
+
+
+def _chunk_layout(frames, entries):
+    """
+    :return: (byte offset from the chunk start, dtype, length) of a chunk's columns, and the chunk's size, every
+    column aligned to 8 bytes.
+    """
+    layout = []
+    offset = CHUNK_HEADER_SIZE
+    for dtype, length in [(np.int64, frames + 1), (np.int32, entries), (np.int32, entries)]:
+        layout.append((offset, dtype, length))
+        offset += (np.dtype(dtype).itemsize * length + 7) // 8 * 8
+    return layout, offset
+
+
+class FrameWriter(object):
+    """
+    Appends frames to a .tvf file, CHUNK_FRAMES at a time, so memory use doesn't grow with the length of a run.
+    """
+
+    def __init__(self, path, chunk_frames=CHUNK_FRAMES):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.frames = 0
+
+        self._file = open(path, 'wb')
+        self._file.write(FRAMES_MAGIC.ljust(FRAMES_HEADER_SIZE, "\0"))
+        self._pending = []
+
+    def write(self, streets, counts):
+        """
+        Add one frame.
+        :param streets: nids of the streets with cars on them.
+        :param counts: # cars on each of them.
+        """
+        self._pending.append((np.asarray(streets, dtype=np.int32), np.asarray(counts, dtype=np.int32)))
+        self.frames += 1
+        if len(self._pending) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered frames out as one chunk.
+        """
+        if not self._pending:
+            return
+
+        sizes = np.array([len(streets) for streets, _ in self._pending], dtype=np.int64)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        columns = [offsets,
+                   np.concatenate([streets for streets, _ in self._pending]),
+                   np.concatenate([counts for _, counts in self._pending])]
+
+        layout, _ = _chunk_layout(len(sizes), int(offsets[-1]))
+        chunk = [struct.pack(CHUNK_HEADER, CHUNK_MAGIC, len(sizes), offsets[-1])]
+        for (_, dtype, _), column in zip(layout, columns):
+            data = np.ascontiguousarray(column, dtype=np.dtype(dtype).newbyteorder('<')).tobytes()
+            chunk.append(data + "\0" * (-len(data) % 8))
+        self._file.write("".join(chunk))
+        self._file.flush()
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameReader(object):
+    """
+    Random access to the frames of a .tvf file. Only the chunk headers are read up front.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        if self._file.read(len(FRAMES_MAGIC)) != FRAMES_MAGIC:
+            raise ValueError(path + " is not a .tvf file")
+
+        # (byte offset, first frame, frames, entries) of every whole chunk
+        self._chunks = []
+        end = os.path.getsize(path)
+        offset = FRAMES_HEADER_SIZE
+        first = 0
+        while offset + CHUNK_HEADER_SIZE <= end:
+            self._file.seek(offset)
+            magic, frames, entries = struct.unpack(CHUNK_HEADER, self._file.read(CHUNK_HEADER_SIZE))
+            _, size = _chunk_layout(frames, entries)
+            if magic != CHUNK_MAGIC or offset + size > end:
+                break
+            self._chunks.append((offset, first, frames, entries))
+            offset += size
+            first += frames
+
+        self._firsts = [chunk[1] for chunk in self._chunks]
+        self._frames = first
+        self._cached = None
+
+    def __len__(self):
+        return self._frames
+
+    def _column(self, chunk, column, start=0, count=None):
+        """
+        :return: count values (all by default) of one column of a chunk, from index start.
+        """
+        offset, _, frames, entries = chunk
+        position, dtype, length = _chunk_layout(frames, entries)[0][column]
+        dtype = np.dtype(dtype).newbyteorder('<')
+        self._file.seek(offset + position + dtype.itemsize * start)
+        return np.fromfile(self._file, dtype=dtype, count=length - start if count is None else count)
+
+    def frame(self, i):
+        """
+        :return: (street nids, car counts) of frame i.
+        """
+        if not 0 <= i < self._frames:
+            raise IndexError("frame %d of %d" % (i, self._frames))
+        chunk = self._chunks[np.searchsorted(self._firsts, i, side='right') - 1]
+
+        # the offsets of the last chunk read are kept, since frames are mostly read in order
+        if self._cached is None or self._cached[0] is not chunk:
+            self._cached = (chunk, self._column(chunk, 0))
+        offsets = self._cached[1]
+
+        start, stop = int(offsets[i - chunk[1]]), int(offsets[i - chunk[1] + 1])
+        return self._column(chunk, 1, start, stop - start), self._column(chunk, 2, start, stop - start)
+
+    def __iter__(self):
+        for i in xrange(self._frames):
+            yield self.frame(i)
+
+    def counter(self, i, street_coordinates):
+        """
+        :return: frame i as in .tvd files, a counter of how many cars are on each street coordinate.
+        """
+        streets, counts = self.frame(i)
+        return street_counter(streets, counts, street_coordinates)
+
+    def close(self):
+        self._file.close()
+
+
+def export_tvd(frames_path, street_coordinates, tvd_path):
+    """
+    Write the frames of a .tvf file as a .tvd file, the pickled list of coordinate Counters.
+    """
+    reader = FrameReader(frames_path)
+    video = [reader.counter(i, street_coordinates) for i in xrange(len(reader))]
+    reader.close()
+    output = open(tvd_path, 'wb')
+    pickle.dump(video, output, 1)
+    output.close()
+
+
+if __name__ == "__main__":
+    # tvd city_name: convert ../data/city_name.tvf to ../data/city_name.tvd
+    if len(sys.argv) == 3 and sys.argv[1] == "tvd":
+        from dualGraph import DualGraph
+        city = sys.argv[2]
+        export_tvd("../data/" + city + ".tvf", DualGraph(city).street_coordinates, "../data/" + city + ".tvd")
@@ -0,0 +1,88 @@
+import numpy as np
+import math
+
+"""
+Vectorized geometry on (N, 2) arrays of (lat, lon) in degrees. Within a city we mostly treat coordinates as
+planar and compare squared euclidean distances in degrees, as osmAnalyzer always has; haversine is there for
+when real distances are needed.
+"""
+
+EARTH_RADIUS = 6371000.0 # metres
+
+# largest number of pairwise distances computed at once by the chunked functions (8 bytes each)
+CHUNK_ELEMENTS = 1 << 22
+
+def asPoints(points):
+	return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+def squaredDistances(a, b):
+	"""
+	(len(a), len(b)) matrix of squared euclidean distances between rows of a and b.
+	"""
+	return ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2)
+
+def rowSquaredDistances(a, b):
+	"""
+	Squared euclidean distance between a[i] and b[i], for every i.
+	"""
+	return ((a - b) ** 2).sum(axis=1)
+
+def haversine(a, b):
+	"""
+	Great circle distance in metres between a[i] and b[i], for every i.
+	"""
+	lat1, lon1 = np.radians(a[:, 0]), np.radians(a[:, 1])
+	lat2, lon2 = np.radians(b[:, 0]), np.radians(b[:, 1])
+	h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+	return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+def midpoints(a, b):
+	"""
+	Average of a[i] and b[i] for every i, the way streets get their coordinates.
+	"""
+	return (a + b) / 2
+
+def smallest(values, n):
+	"""
+	The n smallest values of every row, sorted, and their column indices. argpartition first, so only n values
+	per row ever get sorted.
+	"""
+	n = min(n, values.shape[1])
+	part = np.argpartition(values, n - 1, axis=1)[:, :n]
+	rows = np.arange(values.shape[0])[:, None]
+	order = np.argsort(values[rows, part], axis=1)
+	columns = part[rows, order]
+	return values[rows, columns], columns
+
+def nearest(queries, points, n):
+	"""
+	Squared distances to, and indices of, the n nearest points of every query by brute force, a chunk of queries
+	at a time so that no more than CHUNK_ELEMENTS distances are held at once. See spatialIndex for large inputs.
+	"""
+	queries = asPoints(queries)
+	points = asPoints(points)
+	n = min(n, len(points))
+	distances = np.empty((len(queries), n))
+	indices = np.empty((len(queries), n), dtype=np.int64)
+
+	chunk = max(1, CHUNK_ELEMENTS // max(len(points), 1))
+	for start in xrange(0, len(queries), chunk):
+		end = start + chunk
+		distances[start:end], indices[start:end] = smallest(squaredDistances(queries[start:end], points), n)
+
+	return distances, indices
+
+def boundingBox(points):
+	"""
+	((lat min, lon min), (lat max, lon max)) of the points.
+	"""
+	points = asPoints(points)
+	return tuple(points.min(axis=0)), tuple(points.max(axis=0))
+
+def boxArea(low, high):
+	"""
+	Area in km^2 of a latitude/longitude box, by the formula osmAnalyzer has always used:
+	A = (pi/180)R^2 |sin(lat1)-sin(lat2)| |lon1-lon2|, http://mathforum.org/library/drmath/view/63767.html
+	"""
+	R = EARTH_RADIUS / 1000
+	return math.pi / 180.0 * (R ** 2) * abs(math.sin(high[0]) - math.sin(low[0])) * abs(high[1] - low[1])
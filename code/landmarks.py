@@ -0,0 +1,159 @@
+import numpy as np
+import heapq
+import os
+import random
+import osmParser
+import csrGraph
+
+# landmark tables next to a city's data files
+LANDMARK_EXTENSION = ".alt"
+
+# landmarks per city, and how many of them each search uses
+LANDMARKS = 16
+ACTIVE_LANDMARKS = 4
+
+INFINITY = float("inf")
+
+"""
+ALT (A*, landmarks, triangle inequality) shortest paths on a weighted CSRGraph.
+
+A few landmarks are picked far apart and the distance from each of them to every node is kept in a (k, n) array.
+For any landmark L, |d(L, t) - d(L, v)| <= d(v, t), so the largest of these differences is an admissible and
+consistent A* heuristic, and the search finds exact shortest paths while expanding few nodes off the route.
+"""
+class Landmarks(object):
+
+	def __init__(self, graph, landmarks, distances):
+		self.graph = graph
+		self.landmarks = landmarks
+		self.distances = distances
+		self._lists = None
+
+		# nodes expanded by the last search, for benchmarks
+		self.expanded = 0
+
+	def lists(self):
+		"""
+		The distance table as one python list per landmark, cached, for reading single entries during a search.
+		"""
+		if self._lists is None:
+			self._lists = [row.tolist() for row in self.distances]
+		return self._lists
+
+	def heuristic(self, source, target):
+		"""
+		Lower bound function h(v) on the distance from node v to target, using the ACTIVE_LANDMARKS landmarks that
+		bound the source to target distance best. It is only evaluated for the nodes a search reaches, so a query
+		doesn't cost O(n). Nodes that can't reach target get inf.
+		"""
+		rows = self.lists()
+		def spread(row):
+			difference = abs(row[target] - row[source])
+			return difference if difference == difference else 0.0 # nan where a landmark reaches neither node
+		active = sorted(rows, key=spread, reverse=True)[:ACTIVE_LANDMARKS]
+		pairs = [(row, row[target]) for row in active]
+
+		def h(v):
+			best = 0.0
+			for row, toTarget in pairs:
+				difference = row[v] - toTarget
+				if difference < 0:
+					difference = -difference
+				if difference > best: # false for nan: a landmark that reaches neither node says nothing
+					best = difference
+			return best
+		return h
+
+	def path(self, source, target):
+		"""
+		Indices of a shortest path from index source to index target, both included, or None if there is none.
+		"""
+		indptr, indices, weights = self.graph.lists()
+		h = self.heuristic(source, target)
+
+		dist = {source: 0}
+		previous = {}
+		settled = set()
+		heap = [(h(source), source)]
+		self.expanded = 0
+
+		while heap:
+			_, v = heapq.heappop(heap)
+			if v in settled:
+				continue
+			if v == target:
+				break
+			settled.add(v)
+			self.expanded += 1
+
+			d = dist[v]
+			for k in xrange(indptr[v], indptr[v + 1]):
+				w = indices[k]
+				if w in settled:
+					continue
+				nd = d + weights[k]
+				if nd < dist.get(w, INFINITY):
+					dist[w] = nd
+					previous[w] = v
+					heapq.heappush(heap, (nd + h(w), w))
+		else:
+			return None
+
+		path = [target]
+		while path[-1] != source:
+			path.append(previous[path[-1]])
+		path.reverse()
+		return path
+
+def distanceTable(graph, source):
+	"""
+	Distance from index source to every index as an array, inf where unreachable.
+	"""
+	settled = csrGraph.dijkstra(graph, source)
+	distances = np.empty(graph.GetNodes())
+	distances.fill(INFINITY)
+	distances[np.fromiter(settled.iterkeys(), dtype=np.int64, count=len(settled))] = \
+		np.fromiter(settled.itervalues(), dtype=np.float64, count=len(settled))
+	return distances
+
+def build(graph, k=LANDMARKS, seed=None):
+	"""
+	Pick k landmarks by farthest selection: the first is the node farthest from a random one, every next one is the
+	node farthest from all landmarks so far. Each landmark costs one full Dijkstra, which is also its table row.
+	"""
+	n = graph.GetNodes()
+	k = min(k, n)
+	start = distanceTable(graph, random.Random(seed).randrange(n))
+	landmark = int(np.argmax(np.where(np.isfinite(start), start, -1)))
+
+	landmarks = []
+	distances = np.empty((k, n))
+	nearest = np.empty(n)
+	nearest.fill(INFINITY)
+	for i in xrange(k):
+		landmarks.append(landmark)
+		distances[i] = distanceTable(graph, landmark)
+		nearest = np.minimum(nearest, distances[i])
+		landmark = int(np.argmax(np.where(np.isfinite(nearest), nearest, -1)))
+
+	return Landmarks(graph, np.array(landmarks, dtype=np.int64), distances)
+
+def load(name, graph, k=LANDMARKS):
+	"""
+	The landmarks of a city, read from its landmark file if it was made for the same graph (see CSRGraph.digest) and
+	k, otherwise built and written to it. Distances of a graph with other arcs or weights could overestimate, and
+	the routes found with them would not be shortest.
+	"""
+	path = osmParser.DATA_PATH + name + LANDMARK_EXTENSION
+	digest = graph.digest()
+	if os.path.isfile(path):
+		saved = np.load(path)
+		if 'digest' in saved.files and str(saved['digest']) == digest and len(saved['landmarks']) == k:
+			return Landmarks(graph, saved['landmarks'], saved['distances'])
+
+	result = build(graph, k)
+	temporary = path + ".tmp"
+	with open(temporary, 'wb') as out:
+		np.savez(out, landmarks=result.landmarks, distances=result.distances, digest=np.array(digest))
+	os.rename(temporary, path)
+	return result
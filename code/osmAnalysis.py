@@ -1,6 +1,8 @@
 import snap
 import osmParser
-import math
+import spatialIndex
+import geometry
+import weightedBetween
 import pickle
 import os
 
@@ -144,12 +146,8 @@ class osmAnalyzer(object):
 
 
     def form_closeness_centrality_index(self):
-        index = {}
-        for node in self._graph.Nodes():
-            nid = node.GetId()
-            index[nid] = snap.GetClosenessCentr(self._graph, nid)
-        
-        self._closeness_index = index
+        # same values as snap.GetClosenessCentr on every node, from batched BFS over a CSR copy of the graph
+        self._closeness_index = weightedBetween.bfsCloseness(self._graph)
 
     def form_betweenness_centrality_index(self):
         """
@@ -234,45 +232,11 @@ class osmAnalyzer(object):
             (e.g. intersections) in the city.
         :return: a float, with units km^2/node.
         """
-        coordinates = self._osmid_to_coords.values()
-        latitudes = [coord[0] for coord in coordinates]
-        longitudes = [coord[1] for coord in coordinates]
-        lat_max = max(latitudes)
-        lat_min = min(latitudes)
-        long_max = max(longitudes)
-        long_min = min(longitudes)
-        R = 6371.0
-
-        # http://mathforum.org/library/drmath/view/63767.html
-        # A = (pi/180)R^2 |sin(lat1)-sin(lat2)| |lon1-lon2|
-        self._city_area = math.pi/180.0 * (R ** 2) * abs(math.sin(lat_max) - math.sin(lat_min)) * abs(long_max - long_min)
-        return self._city_area / len(coordinates)
-
-    @staticmethod
-    def _distance(lat1, long1, lat2, long2):
-        """ L2 norm, i.e. euclidean norm, without the sqrt.
-            Because this distance is only relevant in the context of comparing urbanness within 1 city,
-            I won't worry too much about actual physical accuracy.
-        """
-        return (lat1-lat2) ** 2 + (long1-long2) ** 2
+        coordinates = geometry.asPoints(self._osmid_to_coords.values())
+        low, high = geometry.boundingBox(coordinates)
 
-    def _get_urbanness(self, nid, n):
-        """
-        Helper for calculating the urbanness of one single osm node.
-        :return: urbanness(node) := 1 / (average distance to closest n nodes)
-        """
-        osmid = self._nid_to_osmid[nid]
-        n_lat, n_lon = self._osmid_to_coords[osmid]
-
-        coordinates = self._osmid_to_coords.values()
-        distances = []
-        for lat, lon in coordinates:
-            distances.append(self._distance(lat, lon, n_lat, n_lon))
-        
-        # Can optimze this with heapq library and partial sorting.
-        distances = sorted(distances)[:n]
-        urbanness = 1.0 * len(distances) / sum(distances)
-        return urbanness
+        self._city_area = geometry.boxArea(low, high)
+        return self._city_area / len(coordinates)
 
     def form_urbanness_index(self, n=100):
         """
@@ -282,13 +246,18 @@ class osmAnalyzer(object):
 
         The urbanness of a node is a measure of how close that node is to its nearby nodes.
         urbanness(node) := 1 / (average distance to closest n nodes)
+
+        Only nodes of the graph count as neighbors. The n closest (the node itself included) for every node come
+        from one batched query on a grid index, with squared L2 distances (see geometry).
         """
-        index = {}
-        for node in self._graph.Nodes():
-            nid = node.GetId()
-            index[nid] = self._get_urbanness(nid, n)
+        nids = [node.GetId() for node in self._graph.Nodes()]
+        coordinates = [self._osmid_to_coords[self._nid_to_osmid[nid]] for nid in nids]
+
+        grid = spatialIndex.GridIndex(coordinates)
+        distances, _ = grid.knn(coordinates, n)
+        urbanness = distances.shape[1] / distances.sum(axis=1)
 
-        self._urbanness_index = index
+        self._urbanness_index = dict(zip(nids, urbanness.tolist()))
 
 
     def calculate_downtown_center(self):
@@ -1,14 +1,30 @@
-import xml.etree.ElementTree as ET
+try:
+	import xml.etree.cElementTree as ET
+except ImportError:
+	import xml.etree.ElementTree as ET
 import snap
 import json
 import pickle
 import os
 import random
 import sys
+import time
+import resource
+import multiprocessing
+import struct
+import numpy as np
 
 DATA_PATH = "../data/"
 BOUNDARIES_PATH = "../city-boundaries.txt"
 
+# .csr files: a 64 byte header (magic, node count, arc count) followed by contiguous little-endian arrays
+CSR_MAGIC = "USWCSR01"
+CSR_HEADER = "<8sqq"
+CSR_HEADER_SIZE = 64
+
+# rough peak RSS of one streaming parse, per byte of .osm extract. Used to schedule parallel ingestion.
+PARSE_MEMORY_FACTOR = 2
+
 def getBoundaries(city):
 	maxCoord = None
 	minCoord = None
@@ -57,36 +73,82 @@ def createGraph(nodes, edges):
 
 	return G, idToOsmid
 
-def parseToGraph(file_name):
-	tree = ET.parse(file_name)
-	root = tree.getroot()
+# Yield the top-level elements of an OSM file one at a time, clearing each one after it has been
+# processed so that the tree never holds more than the element currently being looked at.
+def iterOSM(file_name):
+	context = ET.iterparse(file_name, events=("start", "end"))
+	depth = 0
+	root = None
+
+	for event, elem in context:
+		if event == "start":
+			if root is None:
+				root = elem
+			depth += 1
+			continue
+
+		depth -= 1
+		if depth != 1: continue # only whole children of <osm>, their <tag>/<nd> stay attached
+
+		yield elem
+
+		elem.clear()
+		root.clear()
+
+# only motorway/trunk/primary/secondary/tertiary ways become edges in the graph
+def isRoad(way):
+	for tag in way.findall('tag'):
+		if tag.attrib['k'] == 'highway':
+			if tag.attrib['v'] in ['motorway', 'trunk', 'primary', 'secondary', 'tertiary']:
+				return True
+	return False
+
+# First pass for pruned parsing: the set of node osmids referenced by any road way.
+def collectWayRefs(file_name):
+	refs = set()
+	for child in iterOSM(file_name):
+		if child.tag == "way":
+			if not isRoad(child):
+				continue
+			for node in child.findall('nd'):
+				refs.add(node.attrib['ref'])
+
+		elif child.tag == "relation":
+			break
+
+	return refs
+
+# prune: read the file twice, and only keep coordinates of nodes that some road way refers to
+def parseToGraph(file_name, streaming=True, prune=False):
+	refs = collectWayRefs(file_name) if prune else None
+
+	if streaming:
+		elements = iterOSM(file_name)
+	else:
+		elements = ET.parse(file_name).getroot()
 
 	nodes = {}
 	edges = {}
 	cityName = file_name.split("/")[-1].split(".")[0]
 	minCoord, maxCoord = getBoundaries(cityName)
 
-	for child in root:
+	for child in elements:
 		if child.tag == "node":
+			id = child.attrib['id']
+			if refs is not None and id not in refs:
+				continue
+
 			lat = float(child.attrib['lat'])
 			lon = float(child.attrib['lon'])
 			# print lat, lon
-			id = child.attrib['id']
 
 			if lat > minCoord[0] and lat < maxCoord[0] and lon > minCoord[1] and lon < maxCoord[1]:
 				nodes[id] = (lat, lon)
 
 		elif child.tag == "way":
-			tags = [tag for tag in child.findall('tag')]
 			id = child.attrib['id']
 
-			shouldTag = False
-			for tag in tags:
-				if tag.attrib['k'] == 'highway':
-					if tag.attrib['v'] in ['motorway', 'trunk', 'primary', 'secondary', 'tertiary']:
-						shouldTag = True
-
-			if not shouldTag:
+			if not isRoad(child):
 				continue
 
 			wayNodes = []
@@ -144,6 +206,93 @@ def loadFromFile(name):
 
 	return G, idToOsmid, coordsMap 
 
+# Node ids (sorted), their coordinates, and the symmetric adjacency in CSR form: the neighbors of nodeIds[i]
+# are nodeIds[indices[indptr[i]:indptr[i+1]]], each row sorted. coords is None without a nodesMap.
+def graphToArrays(G, nodesMap=None):
+	nodeIds = np.array(sorted([node.GetId() for node in G.Nodes()]), dtype=np.int32)
+	coords = None
+	if nodesMap is not None:
+		coords = np.array([nodesMap[nid] for nid in nodeIds], dtype=np.float64).reshape(-1, 2)
+
+	ends = np.array([(edge.GetSrcNId(), edge.GetDstNId()) for edge in G.Edges()], dtype=np.int32).reshape(-1, 2)
+	src = np.searchsorted(nodeIds, ends[:, 0])
+	dst = np.searchsorted(nodeIds, ends[:, 1])
+	loop = src == dst # a self loop is listed once, like snap does
+	src, dst = np.concatenate((src, dst[~loop])), np.concatenate((dst, src[~loop]))
+
+	order = np.lexsort((dst, src))
+	indices = dst[order].astype(np.int32)
+	indptr = np.zeros(len(nodeIds) + 1, dtype=np.int64)
+	np.cumsum(np.bincount(src, minlength=len(nodeIds)), out=indptr[1:])
+
+	return nodeIds, coords, indptr, indices
+
+# (dtype, shape) of each array in a .csr file
+def _csrArrays(numNodes, numArcs):
+	return [(np.int32, (numNodes,)), (np.float64, (numNodes, 2)), (np.int64, (numNodes + 1,)), (np.int32, (numArcs,))]
+
+# byte offset, dtype and shape of each (dtype, shape) array after a headerSize byte header, each aligned to 8 bytes
+def _arrayLayout(headerSize, specs):
+	layout = []
+	offset = headerSize
+	for dtype, shape in specs:
+		layout.append((offset, dtype, shape))
+		size = np.dtype(dtype).itemsize * int(np.prod(shape))
+		offset += (size + 7) // 8 * 8
+	return layout
+
+# Write a packed header, padded to headerSize bytes, then arrays as contiguous little-endian arrays of the
+# (dtype, shape) specs, like a .csr file. dualGraph writes .dual files with it too.
+def writeArrayFile(path, header, headerSize, specs, arrays):
+	out = open(path, 'wb')
+	out.write(header.ljust(headerSize, "\0"))
+	for (offset, dtype, shape), array in zip(_arrayLayout(headerSize, specs), arrays):
+		out.seek(offset)
+		out.write(np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder('<')).tobytes())
+	out.close()
+
+# The values of the struct headerFormat header at the start of a file
+def readArrayHeader(path, headerFormat):
+	file = open(path, 'rb')
+	values = struct.unpack(headerFormat, file.read(struct.calcsize(headerFormat)))
+	file.close()
+	return values
+
+# Read-only memory maps of the arrays of a file written by writeArrayFile
+def mapArrayFile(path, headerSize, specs):
+	return tuple(np.memmap(path, dtype=np.dtype(dtype).newbyteorder('<'), mode='r', offset=offset, shape=shape)
+				 for offset, dtype, shape in _arrayLayout(headerSize, specs))
+
+def saveArraysToFile(nodeIds, coords, indptr, indices, name):
+	header = struct.pack(CSR_HEADER, CSR_MAGIC, len(nodeIds), len(indices))
+	writeArrayFile(DATA_PATH + name + ".csr", header, CSR_HEADER_SIZE, _csrArrays(len(nodeIds), len(indices)),
+				   [nodeIds, coords, indptr, indices])
+
+# Returns read-only memory maps of nodeIds, coords, indptr, indices. Nothing is read until it is touched,
+# and processes mapping the same city share its pages.
+def loadArraysFromFile(name):
+	path = DATA_PATH + name + ".csr"
+	magic, numNodes, numArcs = readArrayHeader(path, CSR_HEADER)
+	if magic != CSR_MAGIC:
+		raise ValueError(path + " is not a .csr file")
+	return mapArrayFile(path, CSR_HEADER_SIZE, _csrArrays(numNodes, numArcs))
+
+# Write the .csr equivalent of a city's .graph and .nodes
+def convertToArrays(name):
+	G, nodesMap = simpleLoadFromFile(name)
+	nodeIds, coords, indptr, indices = graphToArrays(G, nodesMap)
+	saveArraysToFile(nodeIds, coords, indptr, indices, name)
+
+def convertAllToArrays():
+	file = open(BOUNDARIES_PATH, 'r')
+	for line in file:
+		name = line.split(",")[0]
+		if not os.path.isfile(DATA_PATH + name + ".nodes"): continue
+		if os.path.isfile(DATA_PATH + name + ".csr"): continue
+		print "Converting", name
+		convertToArrays(name)
+		print "Finished", name
+
 # Update map to only contain nodes in the graph
 # Map from graph node id to coordinates tuple
 def reduceCoords(name):
@@ -166,7 +315,7 @@ def reduceAllCoords():
 		reduceCoords(name)
 		print "Finished", name
 
-def saveOneOSM(file, path):
+def saveOneOSM(file, path, prune=False):
 	if file == '.DS_Store': return
 
 	name = file.split('.')[0]
@@ -180,7 +329,7 @@ def saveOneOSM(file, path):
 
 	fullpath = os.path.abspath(path)
 	
-	G, idToOsmid, nodes = parseToGraph(fullpath)
+	G, idToOsmid, nodes = parseToGraph(fullpath, prune=prune)
 	
 	saveToFile(G, idToOsmid, nodes, name)
 
@@ -190,17 +339,97 @@ def saveOneOSM(file, path):
 .graph: snap graph
 .id: node id to osmid dictionary
 .coords: osmid to coordinate tuple dictionary
+.csr: node ids, coordinates and adjacency as flat arrays (see saveArraysToFile)
 """
 
-def saveAllOSM(dir):
+def saveAllOSM(dir, prune=False):
 	for folder in os.listdir(dir):
 		if os.path.isfile(folder): continue
 		for file in os.listdir(dir + "/" + folder):
-			saveOneOSM(file, dir + "/" + folder + "/" + file)
+			saveOneOSM(file, dir + "/" + folder + "/" + file, prune)
 
-def saveOneRegion(dir):
+def saveOneRegion(dir, prune=False):
 	for file in os.listdir(dir):
-		saveOneOSM(file, dir + "/" + file)
+		saveOneOSM(file, dir + "/" + file, prune)
+
+# (file, path) pairs for every extract under dir, the same ones saveAllOSM visits
+def listOSMFiles(dir):
+	files = []
+	for folder in os.listdir(dir):
+		if not os.path.isdir(os.path.join(dir, folder)): continue
+		for file in os.listdir(dir + "/" + folder):
+			if file == '.DS_Store': continue
+			files.append((file, dir + "/" + folder + "/" + file))
+	return files
+
+# Runs in its own process, so ru_maxrss is the peak for this city alone (KB on linux).
+def _saveOneOSMWorker(file, path, prune, conn):
+	start = time.time()
+	error = None
+	try:
+		saveOneOSM(file, path, prune)
+	except Exception as e:
+		error = repr(e)
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	conn.send((time.time() - start, rss, error))
+	conn.close()
+
+"""
+Parse many extracts at once, one process per city. Largest files start first, and a city is only started
+if PARSE_MEMORY_FACTOR * (sizes of running files) stays within memoryBudget bytes (default: physical memory).
+A city that raises or dies only fails itself. Returns a list of (name, seconds, peak rss KB, error).
+"""
+def saveAllOSMParallel(files, workers=None, memoryBudget=None, prune=False):
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	if memoryBudget is None:
+		memoryBudget = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+	pending = sorted(files, key=lambda f: os.path.getsize(f[1]), reverse=True)
+	running = [] # (name, process, connection, estimated bytes, start time)
+	results = []
+
+	while pending or running:
+		inUse = sum([job[3] for job in running])
+
+		# start the largest pending cities that fit, always at least one if nothing is running
+		for file, path in list(pending):
+			if len(running) >= workers: break
+			estimate = PARSE_MEMORY_FACTOR * os.path.getsize(path)
+			if running and inUse + estimate > memoryBudget: continue
+
+			parentConn, childConn = multiprocessing.Pipe(False)
+			process = multiprocessing.Process(target=_saveOneOSMWorker, args=(file, path, prune, childConn))
+			process.start()
+			childConn.close()
+
+			running.append((file.split('.')[0], process, parentConn, estimate, time.time()))
+			pending.remove((file, path))
+			inUse += estimate
+
+		time.sleep(0.1)
+
+		for job in list(running):
+			name, process, conn, estimate, start = job
+			if process.is_alive(): continue
+
+			if conn.poll():
+				seconds, rss, error = conn.recv()
+			else: # killed before reporting back, e.g. out of memory
+				seconds, rss, error = time.time() - start, 0, "exit code %s" % process.exitcode
+			process.join()
+			conn.close()
+
+			running.remove(job)
+			results.append((name, seconds, rss, error))
+
+	printSummary(results)
+	return results
+
+def printSummary(results):
+	print "%-30s %10s %12s  %s" % ("city", "seconds", "peak MB", "status")
+	for name, seconds, rss, error in sorted(results, key=lambda r: -r[1]):
+		print "%-30s %10.1f %12.1f  %s" % (name, seconds, rss / 1024.0, error if error else "ok")
 
 # Takes one argument with the 
 if __name__ == "__main__":
@@ -208,6 +437,11 @@ if __name__ == "__main__":
 	if len(sys.argv) > 1: # arguments, run only specified
 		if sys.argv[1] == "reduce": # reduce: reduce coordinates
 			reduceAllCoords()
+		elif sys.argv[1] == "convert": # convert: write .csr arrays from .graph and .nodes
+			convertAllToArrays()
+		elif sys.argv[1] == "parallel": # parallel [workers]: run all, several cities at a time
+			workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+			saveAllOSMParallel(listOSMFiles(dir), workers)
 		else:
 			dir += "/" + sys.argv[1]
 			if os.path.isfile(dir): # run only one city
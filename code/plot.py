@@ -2,7 +2,6 @@ import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import snap
 import pickle
 from matplotlib import collections as mc
 import heapq
@@ -10,6 +9,7 @@ import time
 import sys
 import osmParser
 import weightedBetween
+import geometry
 import os
 import math
 
@@ -48,26 +48,19 @@ k is number of nodes to plot
 def plotTopK(name, values, coords, color, numDivisions=10, k=500, useNodeBetween=True, symbol='.'):
 	topK = heapq.nlargest(k, values, key=values.get)
 
+	if useNodeBetween:
+		latlons = geometry.asPoints([coords[node] for node in topK])
+	else: # edges are plotted at their midpoints
+		latlons = geometry.midpoints(geometry.asPoints([coords[edge[0]] for edge in topK]),
+									 geometry.asPoints([coords[edge[1]] for edge in topK]))
+
+	# numDivisions groups of k / numDivisions, most central first
 	x = []
 	y = []
-	for _ in xrange(numDivisions):
-		x.append([])
-		y.append([])
-
-	index = 0
-	for node in topK:
-		latlon = 0
-		if useNodeBetween:
-			latlon = coords[node]
-		else:
-			lat = (coords[node[0]][0] + coords[node[1]][0]) / float(2)
-			lon = (coords[node[0]][1] + coords[node[1]][1]) / float(2)
-			latlon = (lat, lon)
-
-		x[index / (k / numDivisions)].append(latlon[0])
-		y[index / (k / numDivisions)].append(latlon[1])
-
-		index += 1
+	size = k / numDivisions
+	for i in xrange(numDivisions):
+		x.append(latlons[i * size:(i + 1) * size, 0].tolist())
+		y.append(latlons[i * size:(i + 1) * size, 1].tolist())
 
 	figure = plt.figure()
 
@@ -87,7 +80,9 @@ def plotTopK(name, values, coords, color, numDivisions=10, k=500, useNodeBetween
 
 	plt.close(figure)
 
-def betweenness_test(name):
+# unweighted betweenness from a quarter of the nodes. workers > 1 splits it over a process pool instead of snap,
+# which is faster on a single core.
+def betweenness_test(name, workers=1):
 	if os.path.isfile(DATA_PATH + name + ".between"):
 		print "Skipping", name
 		return
@@ -98,13 +93,15 @@ def betweenness_test(name):
 
 	print "Calculating betweenness", name
 
-	nodeToBetweenness = snap.TIntFltH()
-	edgeToBetweenness = snap.TIntPrFltH()
-	snap.GetBetweennessCentr(G, nodeToBetweenness, edgeToBetweenness, 0.25)
-
-	betweenness = {}
-	for node in nodeToBetweenness:
-		betweenness[node] = nodeToBetweenness[node]
+	if workers == 1:
+		betweenness = weightedBetween.snapBetweenness(G, 0.25)
+	else:
+		samples = int(0.25 * G.GetNodes())
+		betweenness, _ = weightedBetween.betweenness(G, coords, metric="hops", samples=samples, seed=0, workers=workers)
+		# back to snap's scale, a sum over the sampled sources, like the .between files already saved
+		scale = float(samples) / G.GetNodes()
+		for node in betweenness:
+			betweenness[node] *= scale
 
 	betweenOut = open(DATA_PATH + name + ".between", 'w')
 	pickle.dump(betweenness, betweenOut, 1)
@@ -114,7 +111,7 @@ def betweenness_test(name):
 	end = time.time()
 	print "took", end - start, "seconds"
 
-def weighted_between_test(name):
+def weighted_between_test(name, epsilon=weightedBetween.EPSILON, delta=weightedBetween.DELTA, seed=None):
 	if os.path.isfile(DATA_PATH + name + ".wbetween"):
 		print "Skipping", name
 		return
@@ -123,7 +120,7 @@ def weighted_between_test(name):
 
 	print "Calculating weighted betweenness", name
 
-	betweenness, coords = weightedBetween.analyzeCity(name)
+	betweenness, intervals, coords = weightedBetween.analyzeCity(name, epsilon, delta, seed)
 
 	betweenOut = open(DATA_PATH + name + ".wbetween", 'w')
 	pickle.dump(betweenness, betweenOut, 1)
@@ -133,7 +130,8 @@ def weighted_between_test(name):
 	end = time.time()
 	print "took", end - start, "seconds"
 
-def closeness_test(name):
+# exact closeness, split over workers processes
+def closeness_test(name, workers=1):
 	if os.path.isfile(DATA_PATH + name + ".closeness"):
 		print "Skipping", name
 		return
@@ -144,11 +142,8 @@ def closeness_test(name):
 
 	print "Calculating closeness", name
 
-	##
-	nodeToCloseness = {}
-	for node in G.Nodes():
-		nodeToCloseness[node.GetId()] = snap.GetClosenessCentr(G, node.GetId())
-	##
+	nodeToCloseness = weightedBetween.bfsCloseness(G, coords, workers=workers,
+												   checkpoint=DATA_PATH + name + ".closeness.ckpt")
 
 	closeOut = open(DATA_PATH + name + ".closeness", 'w')
 	pickle.dump(nodeToCloseness, closeOut, 1)
@@ -211,7 +206,8 @@ def approx_closeness_test(name):
 
 	print "Calculating approx closeness", name
 
-	closeness = weightedBetween.approxCloseness(G, coords)
+	closeness, errors, pivots = weightedBetween.approxCloseness(G, coords)
+	print "used", pivots, "pivots, median standard error", np.median(errors.values())
 
 	closeOut = open(DATA_PATH + name + ".acloseness", 'w')
 	pickle.dump(closeness, closeOut, 1)
@@ -361,4 +357,12 @@ if __name__ == "__main__":
 			approx_closeness_test(name)
 		elif arg1 == "urban":
 			urbanness_test(name)
-
+	elif len(sys.argv) == 4: # wbetween city_name epsilon, between/closeness city_name workers
+		arg1 = sys.argv[1]
+		name = sys.argv[2]
+		if arg1 == "wbetween":
+			weighted_between_test(name, epsilon=float(sys.argv[3]))
+		elif arg1 == "between":
+			betweenness_test(name, workers=int(sys.argv[3]))
+		elif arg1 == "closeness":
+			closeness_test(name, workers=int(sys.argv[3]))
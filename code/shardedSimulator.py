@@ -0,0 +1,290 @@
+from arraySimulator import ArrayTrafficSimulator
+from trafficSimulator import TrafficSimulator
+from dualGraph import DualGraph
+from frames import street_counter
+import multiprocessing
+import numpy as np
+import spatialIndex
+import sys
+import time
+
+
+class ShardedTrafficSimulator(object):
+    """
+    The simulation of ArrayTrafficSimulator split over worker processes, for more cars than one process can move.
+
+    The streets are cut into one spatial region per worker by their street_coordinates (see spatialIndex.bisect).
+    Each worker simulates the cars that are on its streets. Every street belongs to exactly one region, so a
+    street's car count is always the one worker's own count. When a car moves onto a street of another region
+    during a tick, its worker hands it over, with the rest of its itinerary, to this coordinator. The coordinator
+    passes it on to the new worker before the next tick starts.
+
+    Same interface as TrafficSimulator: run_simulation, cumulative_car_data, traffic_video_data. Call close() when
+    done, to stop the workers.
+
+    Every tick is one round trip to every worker, since a car handed over must be counted on its new street before
+    the next tick. On one core that only costs: with 3500 cars on Accra, one worker ran at 0.91-0.94 times the speed
+    of a single ArrayTrafficSimulator, and two workers on that core at 0.46-0.91 times. Time it on the machine at
+    hand with `python shardedSimulator.py benchmark city workers` before choosing it.
+    """
+
+    def __init__(self, dual_graph, num_cars, workers=None, router="alt", cache_size=0, seed=None):
+        """
+        :param dual_graph: dual graph to simulate on.
+        :param num_cars: # cars, over all workers.
+        :param workers: # worker processes and regions, the number of cores by default.
+        :param router: routing backend of every worker, see DualGraph.router.
+        :param cache_size: size of every worker's own route cache, none by default (see ROUTE_CACHE_SIZE).
+        :param seed: worker i seeds its random numbers with seed + i.
+        """
+        self.city_roads = dual_graph
+        self.workers = workers if workers is not None else multiprocessing.cpu_count()
+        self.traffic_video_data = []
+
+        csr = dual_graph.csr
+        self.regions = spatialIndex.bisect(csr.coords, self.workers)
+        # The snapshots taken so far, added up: # cars seen on every street, by street nid.
+        self.street_car_data = np.zeros(int(csr.nodeIds.max()) + 1, dtype=np.int64)
+
+        # routing tables are loaded here, once, and shared with the workers when they fork
+        dual_graph.router(router)
+
+        self._connections = []
+        self._processes = []
+        for region in xrange(self.workers):
+            cars = num_cars // self.workers + (1 if region < num_cars % self.workers else 0)
+            shard_seed = seed + region if seed is not None else None
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(
+                dual_graph, self.regions, region, cars, router, cache_size, shard_seed, worker_connection))
+            process.daemon = True
+            process.start()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+        # Workers start their cars anywhere, and first hand over the ones outside their region.
+        self._in_flight = self._gather(self._receive())
+
+    def _receive(self):
+        """
+        :return: the next message of every worker, in region order.
+        """
+        return [connection.recv() for connection in self._connections]
+
+    def _gather(self, departures):
+        """
+        :param departures: every worker's {region: cars} of cars that left it.
+        :return: the cars each region receives, as a list of car states per region.
+        """
+        incoming = [[] for _ in xrange(self.workers)]
+        for worker_departures in departures:
+            for region, cars in worker_departures.iteritems():
+                incoming[region].append(cars)
+        return incoming
+
+    def _occupancy(self, occupancies):
+        """
+        :param occupancies: every worker's (streets, counts) of the cars it kept.
+        :return: # cars on every street, by csr index, including the cars being handed over.
+        """
+        counts = np.zeros(len(self.city_roads.csr.nodeIds), dtype=np.int64)
+        for streets, street_counts in occupancies:
+            counts[streets] += street_counts
+
+        for region_cars in self._in_flight:
+            for cars in region_cars:
+                starts = np.cumsum(cars["lengths"]) - cars["lengths"]
+                counts += np.bincount(cars["itineraries"][starts], minlength=len(counts))
+        return counts
+
+    def tick(self, snapshot=False):
+        """
+        Hand over the cars in flight, advance every worker one tick, and collect the cars that left their region.
+        :param snapshot: whether to also return the current car distribution.
+        :return: # cars on every street by csr index, if snapshot.
+        """
+        for connection, incoming in zip(self._connections, self._in_flight):
+            connection.send(("tick", incoming, snapshot))
+        results = self._receive()
+
+        self._in_flight = self._gather([departures for departures, _ in results])
+        if snapshot:
+            return self._occupancy([occupancy for _, occupancy in results])
+
+    def run_simulation(self, max_ticks, frame_rate, type='data', sink=None):
+        """
+        Runs the simulation for max_ticks time steps, taking a picture every frame_rate steps.
+        :param max_ticks: some #
+        :param frame_rate: some #
+        :param sink: for type 'video', a frames.FrameWriter to stream the pictures to.
+        :return: None
+        """
+        for i in xrange(max_ticks):
+            if i % 1000 == 0:
+                print "generation", i
+            counts = self.tick(snapshot=(i % frame_rate == 0))
+            if counts is None:
+                continue
+
+            streets = self.city_roads.csr.nodeIds
+            if type == 'data':
+                self.street_car_data[streets] += counts
+            elif type == 'video':
+                occupied = np.flatnonzero(counts)
+                if sink is not None:
+                    sink.write(streets[occupied], counts[occupied])
+                else:
+                    self.traffic_video_data.append(
+                        street_counter(streets[occupied], counts[occupied], self.city_roads.street_coordinates))
+
+    # over street_car_data and city_roads, which this keeps the same way
+    cumulative_car_data = TrafficSimulator.cumulative_car_data
+
+    def statistics(self):
+        """
+        :return: (# cars, # completed trips), over all workers and the cars in flight.
+        """
+        for connection in self._connections:
+            connection.send(("statistics",))
+        cars, trips = map(sum, zip(*self._receive()))
+
+        for region_cars in self._in_flight:
+            for in_flight in region_cars:
+                cars += len(in_flight["lengths"])
+                trips += int(in_flight["trips"].sum())
+        return cars, trips
+
+    def close(self):
+        """
+        Stop the workers.
+        """
+        for connection in self._connections:
+            connection.send(("stop",))
+        for process in self._processes:
+            process.join()
+
+
+class _Shard(ArrayTrafficSimulator):
+    """
+    An ArrayTrafficSimulator whose cars can be taken out and put in, that keeps only the cars on its region.
+    """
+
+    def __init__(self, dual_graph, num_cars, regions, region, router, cache_size, seed):
+        self._regions = regions
+        self.region = region
+        super(_Shard, self).__init__(dual_graph, num_cars, router, cache_size, None, seed)
+
+    def _cars(self, cars):
+        """
+        :return: the state of cars from their current street on: itinerary lengths, concatenated itineraries,
+        progress and completed trips.
+        """
+        start = self.offset[cars] + self.position[cars]
+        lengths = self.length[cars] - self.position[cars]
+        ranges = np.repeat(start - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return {"lengths": lengths, "itineraries": self._buffer[ranges],
+                "progress": self.progress[cars], "trips": self.completed_trips[cars]}
+
+    def _keep(self, keep):
+        self.offset = self.offset[keep]
+        self.length = self.length[keep]
+        self.position = self.position[keep]
+        self.progress = self.progress[keep]
+        self.completed_trips = self.completed_trips[keep]
+
+    def add(self, cars):
+        """
+        Take over the cars of a state from _cars.
+        """
+        lengths = cars["lengths"]
+        total = int(lengths.sum())
+        self._reserve(total)
+        self._buffer[self._used:self._used + total] = cars["itineraries"]
+
+        self.offset = np.concatenate((self.offset, self._used + np.cumsum(lengths) - lengths))
+        self.length = np.concatenate((self.length, lengths))
+        self.position = np.concatenate((self.position, np.zeros(len(lengths), dtype=np.int64)))
+        self.progress = np.concatenate((self.progress, cars["progress"]))
+        self.completed_trips = np.concatenate((self.completed_trips, cars["trips"]))
+        self._used += total
+
+        starts = np.cumsum(lengths) - lengths
+        np.add.at(self.car_counts, self._nids[cars["itineraries"][starts]], 1)
+
+    def depart(self):
+        """
+        Remove the cars that are not on this region's streets.
+        :return: {region: state of the cars now on it}
+        """
+        destinations = self._regions[self.current_streets()]
+        leaving = np.flatnonzero(destinations != self.region)
+        if not len(leaving):
+            return {}
+
+        departures = {}
+        for region in np.unique(destinations[leaving]).tolist():
+            departures[region] = self._cars(leaving[destinations[leaving] == region])
+        np.subtract.at(self.car_counts, self._nids[self.current_streets()[leaving]], 1)
+        self._keep(destinations == self.region)
+        return departures
+
+    def occupancy(self):
+        """
+        :return: (streets, counts) of the streets with cars on them.
+        """
+        counts = np.bincount(self.current_streets(), minlength=self._streets)
+        streets = np.flatnonzero(counts)
+        return streets, counts[streets]
+
+
+def _shard_worker(dual_graph, regions, region, num_cars, router, cache_size, seed, connection):
+    shard = _Shard(dual_graph, num_cars, regions, region, router, cache_size, seed)
+    connection.send(shard.depart())
+
+    while True:
+        message = connection.recv()
+        if message[0] == "stop":
+            break
+        elif message[0] == "statistics":
+            connection.send((len(shard.offset), int(shard.completed_trips.sum())))
+        elif message[0] == "tick":
+            _, incoming, snapshot = message
+            for cars in incoming:
+                shard.add(cars)
+            shard.tick()
+            departures = shard.depart()
+            connection.send((departures, shard.occupancy() if snapshot else None))
+
+    connection.close()
+
+
+def benchmark_sharding(dual_graph, cars=3500, workers=None, ticks=300, seed=0):
+    """
+    Time the same number of cars in one ArrayTrafficSimulator and in a ShardedTrafficSimulator, routing tables loaded
+    beforehand.
+    :return: {"array": seconds per tick, "sharded": seconds per tick}
+    """
+    dual_graph.router("alt")
+    array = ArrayTrafficSimulator(dual_graph, cars, seed=seed)
+    start = time.time()
+    for _ in xrange(ticks):
+        array.tick()
+    array_tick = (time.time() - start) / ticks
+
+    sharded = ShardedTrafficSimulator(dual_graph, cars, workers=workers, seed=seed)
+    start = time.time()
+    for _ in xrange(ticks):
+        sharded.tick()
+    sharded_tick = (time.time() - start) / ticks
+    sharded.close()
+
+    return {"array": array_tick, "sharded": sharded_tick}
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 4 and sys.argv[1] == "benchmark":
+        workers = int(sys.argv[3])
+        times = benchmark_sharding(DualGraph(sys.argv[2]), workers=workers)
+        print "array: %.2f ms per tick, sharded over %d workers: %.2f ms per tick (%.2fx)" % \
+              (times["array"] * 1e3, workers, times["sharded"] * 1e3, times["array"] / times["sharded"])
@@ -0,0 +1,130 @@
+import numpy as np
+import geometry
+
+"""
+A uniform grid over (lat, lon) points, for batched nearest neighbour queries within one city.
+Distances are plain euclidean in degrees and are returned squared, like osmAnalyzer._distance.
+
+Points are sorted by cell, row by row, so a block of neighbouring cells is a handful of contiguous slices.
+Queries are grouped by the cell they fall in and every group is answered by geometry.nearest over the points of
+the cells around it, so memory stays bounded however many queries fall in one cell.
+"""
+class GridIndex(object):
+
+	def __init__(self, points, pointsPerCell=16):
+		self.points = geometry.asPoints(points)
+		n = len(self.points)
+
+		self.low = self.points.min(axis=0)
+		extent = self.points.max(axis=0) - self.low
+		area = max(extent[0], 1e-9) * max(extent[1], 1e-9)
+		self.cellSize = (area * pointsPerCell / max(n, 1)) ** 0.5
+		self.shape = (extent // self.cellSize).astype(np.int64) + 1
+
+		cells = self._cellsOf(self.points)
+		cellIds = cells[:, 0] * self.shape[1] + cells[:, 1]
+		self.order = np.argsort(cellIds, kind='mergesort')
+		self.cellStart = np.searchsorted(cellIds[self.order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+	def cellOf(self):
+		"""
+		Cell id (row * columns + column) of every indexed point.
+		"""
+		cells = np.empty(len(self.points), dtype=np.int64)
+		cells[self.order] = np.repeat(np.arange(self.shape[0] * self.shape[1]), np.diff(self.cellStart))
+		return cells
+
+	def _cellsOf(self, points):
+		cells = ((points - self.low) // self.cellSize).astype(np.int64)
+		return np.clip(cells, 0, self.shape - 1)
+
+	def _block(self, cell, rings):
+		"""
+		Indices of all points within rings cells of cell, and the clipped block bounds (x0, x1, y0, y1) in cells.
+		"""
+		x0, x1 = max(cell[0] - rings, 0), min(cell[0] + rings, self.shape[0] - 1)
+		y0, y1 = max(cell[1] - rings, 0), min(cell[1] + rings, self.shape[1] - 1)
+		slices = [self.order[self.cellStart[x * self.shape[1] + y0]:self.cellStart[x * self.shape[1] + y1 + 1]]
+				  for x in xrange(x0, x1 + 1)]
+		return np.concatenate(slices), (x0, x1, y0, y1)
+
+	def _safeDistance(self, queries, bounds):
+		"""
+		Squared distance from each query to the nearest point the block (x0, x1, y0, y1) could be missing. Sides of
+		the block on the edge of the grid have nothing beyond them.
+		"""
+		x0, x1, y0, y1 = bounds
+		safe = np.empty(len(queries))
+		safe.fill(np.inf)
+		if x0 > 0: safe = np.minimum(safe, queries[:, 0] - (self.low[0] + x0 * self.cellSize))
+		if x1 < self.shape[0] - 1: safe = np.minimum(safe, self.low[0] + (x1 + 1) * self.cellSize - queries[:, 0])
+		if y0 > 0: safe = np.minimum(safe, queries[:, 1] - (self.low[1] + y0 * self.cellSize))
+		if y1 < self.shape[1] - 1: safe = np.minimum(safe, self.low[1] + (y1 + 1) * self.cellSize - queries[:, 1])
+		return np.where(safe > 0, safe, 0) ** 2
+
+	def _groups(self, queries):
+		"""
+		(cell, query positions) for every cell that some query falls in.
+		"""
+		cells = self._cellsOf(queries)
+		cellIds = cells[:, 0] * self.shape[1] + cells[:, 1]
+		order = np.argsort(cellIds, kind='mergesort')
+		bounds = np.flatnonzero(np.diff(cellIds[order])) + 1
+		for group in np.split(order, bounds):
+			if len(group):
+				yield cells[group[0]], group
+
+	def knn(self, queries, k):
+		"""
+		The k nearest points to every query. Returns (squared distances, point indices), both (len(queries), k) and
+		sorted by distance. A query that is one of the points finds itself at distance 0.
+		"""
+		queries = geometry.asPoints(queries)
+		k = min(k, len(self.points))
+		distances = np.empty((len(queries), k))
+		neighbours = np.empty((len(queries), k), dtype=np.int64)
+		startRings = int(np.ceil(((float(k) / len(self.points)) * self.shape[0] * self.shape[1]) ** 0.5 / 2))
+
+		for cell, group in self._groups(queries):
+			rings = startRings
+			while len(group):
+				candidates, bounds = self._block(cell, rings)
+				rings += 1
+				if len(candidates) < k:
+					continue
+
+				d, columns = geometry.nearest(queries[group], self.points[candidates], k)
+
+				# only final once the k-th neighbour is closer than anything outside the block
+				done = d[:, -1] <= self._safeDistance(queries[group], bounds)
+				distances[group[done]] = d[done]
+				neighbours[group[done]] = candidates[columns[done]]
+				group = group[~done]
+
+		return distances, neighbours
+
+def bisect(points, parts):
+	"""
+	Split points into parts regions of (nearly) equal size by recursive coordinate bisection: every split cuts the
+	longer side of the bounding box, at the point that shares the regions out evenly between the two halves.
+	Returns the region, 0..parts-1, of every point.
+	"""
+	points = geometry.asPoints(points)
+	regions = np.zeros(len(points), dtype=np.int64)
+	stack = [(np.arange(len(points)), 0, parts)]
+
+	while stack:
+		members, first, count = stack.pop()
+		if count == 1:
+			regions[members] = first
+			continue
+
+		left = count // 2
+		extent = points[members].max(axis=0) - points[members].min(axis=0) if len(members) else np.zeros(2)
+		axis = int(np.argmax(extent))
+		members = members[np.argsort(points[members, axis], kind='mergesort')]
+		cut = len(members) * left // count
+		stack.append((members[:cut], first, left))
+		stack.append((members[cut:], first + left, count - left))
+
+	return regions
@@ -0,0 +1,306 @@
+import unittest
+import itertools
+import pickle
+import random
+import shutil
+import tempfile
+import numpy as np
+import snap
+import osmParser
+import csrGraph
+import weightedBetween
+import landmarks
+import contraction
+import dualGraph
+import routeCache
+
+"""
+Small graph checks of the exact algorithms against snap or brute force. Run from code/:
+
+	python -m unittest test_algorithms
+"""
+
+# column and row positions of the grid graphs: integers, so that equal length paths tie exactly
+XS = [0, 1, 3, 4, 6]
+YS = [0, 2, 3, 5]
+
+def gridGraph(removed=0, seed=0):
+	"""
+	A snap grid of len(XS) * len(YS) nodes at integer coordinates, with lots of equal length shortest paths, less
+	removed random edges (keeping it connected). Returns the graph and its nodesMap.
+	"""
+	G = snap.TUNGraph.New()
+	coords = {}
+	for i, x in enumerate(XS):
+		for j, y in enumerate(YS):
+			nid = i * len(YS) + j
+			G.AddNode(nid)
+			coords[nid] = (float(x), float(y))
+	edges = []
+	for i, j in itertools.product(xrange(len(XS)), xrange(len(YS))):
+		if i + 1 < len(XS):
+			edges.append((i * len(YS) + j, (i + 1) * len(YS) + j))
+		if j + 1 < len(YS):
+			edges.append((i * len(YS) + j, i * len(YS) + j + 1))
+	for a, b in edges:
+		G.AddEdge(a, b)
+
+	rng = random.Random(seed)
+	for a, b in rng.sample(edges, len(edges)):
+		if removed == 0:
+			break
+		G.DelEdge(a, b)
+		if snap.IsConnected(G):
+			removed -= 1
+		else:
+			G.AddEdge(a, b)
+	return G, coords
+
+def randomGraph(nodes=60, edges=150, seed=0):
+	"""
+	A connected random snap graph with random coordinates, so that shortest paths are unique.
+	"""
+	rnd = snap.TRnd(seed)
+	G = snap.GenRndGnm(snap.PUNGraph, nodes, edges, False, rnd)
+	G = snap.GetMxScc(G)
+	rng = random.Random(seed)
+	coords = dict((node.GetId(), (rng.random(), rng.random())) for node in G.Nodes())
+	return G, coords
+
+def floyd(graph):
+	"""
+	All pairs distances of a weighted CSRGraph, by index.
+	"""
+	n = graph.GetNodes()
+	dist = np.empty((n, n))
+	dist.fill(np.inf)
+	np.fill_diagonal(dist, 0.0)
+	indptr, indices, weights = graph.lists()
+	for v in xrange(n):
+		for k in xrange(indptr[v], indptr[v + 1]):
+			dist[v, indices[k]] = min(dist[v, indices[k]], weights[k])
+	for m in xrange(n):
+		dist = np.minimum(dist, dist[:, m:m + 1] + dist[m:m + 1, :])
+	return dist
+
+def pathLength(graph, path):
+	"""
+	Length of a path of indices, over the shortest arc between consecutive nodes, None if they are not adjacent.
+	"""
+	indptr, indices, weights = graph.lists()
+	total = 0.0
+	for v, w in zip(path, path[1:]):
+		arcs = [weights[k] for k in xrange(indptr[v], indptr[v + 1]) if indices[k] == w]
+		if not arcs:
+			return None
+		total += min(arcs)
+	return total
+
+def bruteBetweenness(graph):
+	"""
+	Node and edge betweenness by index and by (smaller, larger) index pair, summed over ordered pairs of nodes,
+	from path counts over the all pairs distances. Weights must be positive.
+	"""
+	n = graph.GetNodes()
+	dist = floyd(graph)
+	indptr, indices, weights = graph.lists()
+	arcs = [(v, indices[k], weights[k]) for v in xrange(n) for k in xrange(indptr[v], indptr[v + 1])]
+
+	sigma = np.zeros((n, n))
+	for s in xrange(n):
+		sigma[s, s] = 1
+		for v in sorted(xrange(n), key=lambda v: dist[s, v]):
+			for u, w, weight in arcs:
+				if w == v and u != v and dist[s, u] + weight == dist[s, v]:
+					sigma[s, v] += sigma[s, u]
+
+	nodes = np.zeros(n)
+	edges = {}
+	for s, t in itertools.permutations(xrange(n), 2):
+		for v in xrange(n):
+			if v != s and v != t and dist[s, v] + dist[v, t] == dist[s, t]:
+				nodes[v] += sigma[s, v] * sigma[v, t] / sigma[s, t]
+		for u, w, weight in arcs:
+			if dist[s, u] + weight + dist[w, t] == dist[s, t]:
+				key = (min(u, w), max(u, w))
+				edges[key] = edges.get(key, 0.0) + sigma[s, u] * sigma[w, t] / sigma[s, t]
+	return nodes, edges
+
+
+class BetweennessTest(unittest.TestCase):
+
+	def testBrandesMatchesBruteForce(self):
+		for removed in (0, 4):
+			G, coords = gridGraph(removed)
+			nodeBetween, edgeBetween = weightedBetween.betweenness(G, coords)
+			graph = weightedBetween.weightedGraph(G, coords)
+			nodes, edges = bruteBetweenness(graph)
+
+			ids = graph.idList()
+			for v in xrange(graph.GetNodes()):
+				self.assertAlmostEqual(nodeBetween[ids[v]], nodes[v] / 2)
+			for (a, b), value in edges.iteritems():
+				self.assertAlmostEqual(edgeBetween[(ids[a], ids[b])], value)
+
+	def testHopsMatchSnap(self):
+		G, coords = randomGraph()
+		nodeBetween, edgeBetween = weightedBetween.betweenness(G, coords, metric="hops", workers=2)
+		nodes = snap.TIntFltH()
+		edges = snap.TIntPrFltH()
+		snap.GetBetweennessCentr(G, nodes, edges, 1.0)
+		for node in nodes:
+			self.assertAlmostEqual(nodeBetween[node], nodes[node])
+		for edge in edges:
+			a, b = edge.GetVal1(), edge.GetVal2()
+			self.assertAlmostEqual(edgeBetween[(min(a, b), max(a, b))], edges[edge])
+
+	def testZeroLengthEdge(self):
+		# path 0-1-2-3 where 1 and 2 are at the same place
+		G = snap.TUNGraph.New()
+		for v in xrange(4):
+			G.AddNode(v)
+		for v in xrange(3):
+			G.AddEdge(v, v + 1)
+		coords = {0: (0.0, 0.0), 1: (0.0, 1.0), 2: (0.0, 1.0), 3: (0.0, 2.0)}
+		nodeBetween, edgeBetween = weightedBetween.betweenness(G, coords)
+		self.assertEqual(nodeBetween, {0: 0.0, 1: 2.0, 2: 2.0, 3: 0.0})
+		self.assertEqual(edgeBetween, {(0, 1): 6.0, (1, 2): 8.0, (2, 3): 6.0})
+
+	def testSamplingStopsEarly(self):
+		G = snap.GenGrid(snap.PUNGraph, 20, 20, False)
+		rng = random.Random(0)
+		coords = dict((v, (v % 20 + 0.3 * rng.random(), v // 20 + 0.3 * rng.random())) for v in xrange(400))
+		_, exact = weightedBetween.betweenness(G, coords)
+
+		estimates, intervals, k = weightedBetween.algorithm2(G, coords, epsilon=0.3, topEdges=10, seed=0)
+		self.assertLess(k, 400)
+		for edge in sorted(exact, key=exact.get, reverse=True)[:10]:
+			self.assertLess(abs(estimates[edge] - exact[edge]), 0.3 * estimates[edge])
+
+		estimates, intervals, k = weightedBetween.algorithm2(G, coords, epsilon=0.0, seed=0)
+		self.assertEqual(k, 400)
+		for edge, value in exact.iteritems():
+			self.assertAlmostEqual(estimates[edge], value)
+			self.assertAlmostEqual(intervals[edge][1] - intervals[edge][0], 0.0)
+		self.assertTrue(np.isinf(weightedBetween._normalWidths([0.5], [0.25], 1, 400, 0.1)).all())
+
+
+class SearchTest(unittest.TestCase):
+
+	def setUp(self):
+		G, coords = randomGraph()
+		self.graph = weightedBetween.weightedGraph(G, coords)
+		self.dist = floyd(self.graph)
+
+	def testDijkstra(self):
+		for s in xrange(0, self.graph.GetNodes(), 7):
+			settled = csrGraph.dijkstra(self.graph, s)
+			self.assertEqual(sorted(settled), range(self.graph.GetNodes()))
+			for v, d in settled.iteritems():
+				self.assertAlmostEqual(d, self.dist[s, v])
+
+	def testDijkstraStops(self):
+		s = 3
+		nearest = csrGraph.dijkstra(self.graph, s, maxNodes=10)
+		self.assertEqual(len(nearest), 10)
+		self.assertLessEqual(max(nearest.values()), np.sort(self.dist[s])[10])
+
+		radius = np.median(self.dist[s])
+		inside = csrGraph.dijkstra(self.graph, s, radius=radius)
+		self.assertEqual(sorted(inside), sorted(np.flatnonzero(self.dist[s] <= radius).tolist()))
+
+		targets = [5, 17, 40]
+		found = csrGraph.dijkstra(self.graph, s, targets=targets)
+		for t in targets:
+			self.assertAlmostEqual(found[t], self.dist[s, t])
+
+	def testBoundedSearch(self):
+		search = csrGraph.BoundedSearch(self.graph)
+		for s in xrange(0, self.graph.GetNodes(), 5):
+			expected = np.sort(self.dist[s])
+			np.testing.assert_allclose(search.run(s), expected)
+			np.testing.assert_allclose(search.run(s, maxNodes=12), expected[:12])
+			radius = expected[len(expected) // 3:len(expected) // 3 + 2].mean() # between two distances
+			np.testing.assert_allclose(search.run(s, radius=radius), expected[expected <= radius])
+
+
+class ClosenessTest(unittest.TestCase):
+
+	def testBfsClosenessMatchesSnap(self):
+		G = snap.GenRndGnm(snap.PUNGraph, 300, 450, False, snap.TRnd(1)) # a few components
+		for workers in (1, 2):
+			closeness = weightedBetween.bfsCloseness(G, workers=workers)
+			for node in G.Nodes():
+				self.assertAlmostEqual(closeness[node.GetId()], snap.GetClosenessCentr(G, node.GetId()))
+
+
+class RoutingTest(unittest.TestCase):
+
+	def testRoutesAreShortest(self):
+		G, coords = randomGraph(200, 500)
+		graph = weightedBetween.weightedGraph(G, coords)
+		alt = landmarks.build(graph, k=4, seed=0)
+		ch = contraction.build(graph)
+
+		rng = random.Random(0)
+		n = graph.GetNodes()
+		for _ in xrange(100):
+			s, t = rng.randrange(n), rng.randrange(n)
+			expected = csrGraph.dijkstra(graph, s, targets=[t])[t]
+			for router in (alt, ch):
+				path = router.path(s, t)
+				self.assertEqual((path[0], path[-1]), (s, t))
+				self.assertAlmostEqual(pathLength(graph, path), expected)
+
+
+class FileTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dataPath = osmParser.DATA_PATH
+		osmParser.DATA_PATH = tempfile.mkdtemp() + "/"
+		G, coords = gridGraph(3)
+		G.Save(snap.TFOut(osmParser.DATA_PATH + "grid.graph"))
+		pickle.dump(coords, open(osmParser.DATA_PATH + "grid.nodes", 'wb'), 1)
+		self.G, self.coords = G, coords
+
+	def tearDown(self):
+		shutil.rmtree(osmParser.DATA_PATH)
+		osmParser.DATA_PATH = self.dataPath
+
+	def testCsrRoundTrip(self):
+		expected = osmParser.graphToArrays(self.G, self.coords)
+		osmParser.convertToArrays("grid")
+		for array, saved in zip(expected, osmParser.loadArraysFromFile("grid")):
+			np.testing.assert_array_equal(array, saved)
+
+		graph = csrGraph.load("grid", "metres")
+		reloaded = csrGraph.load("grid", "metres")
+		self.assertIsInstance(reloaded.weights, np.memmap)
+		np.testing.assert_array_equal(graph.weights, reloaded.weights)
+
+	def testDualRoundTrip(self):
+		built = dualGraph.DualGraph("grid", cache=False)
+		dualGraph.DualGraph("grid") # writes the .dual file
+		self.assertIsNotNone(dualGraph.load_dual("grid"))
+		cached = dualGraph.DualGraph("grid")
+
+		self.assertEqual(cached.street_weights, built.street_weights)
+		self.assertEqual(cached.street_coordinates, built.street_coordinates)
+		self.assertEqual(cached.possible_endpoints, built.possible_endpoints)
+		np.testing.assert_array_equal(cached.csr.indptr, built.csr.indptr)
+		np.testing.assert_array_equal(cached.csr.indices, built.csr.indices)
+
+	def testRouteCacheFileDigest(self):
+		path = osmParser.DATA_PATH + "grid.routes"
+		cache = routeCache.RouteCache(10, path, "a")
+		self.assertEqual(cache.get(1, 3, lambda: [1, 2, 3]), (1, 2, 3))
+		self.assertEqual(cache.get(3, 1, lambda: [None]), (3, 2, 1))
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+		cache.save()
+
+		self.assertEqual(len(routeCache.RouteCache(10, path, "a")), 2)
+		self.assertEqual(len(routeCache.RouteCache(10, path, "b")), 0)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,26 +1,38 @@
-from dualGraph import DualGraph
+from dualGraph import DualGraph, ROUTERS
 from Car import DualGraphCar
+from routeCache import RouteCache, ROUTE_CACHE_SIZE
+from frames import FrameWriter, street_counter
 import osmParser
 from collections import defaultdict
-from collections import Counter
 import math
+import numpy as np
 import pickle
+import random
+import sys
+import time
 
 class TrafficSimulator(object):
 
-    def __init__(self, dual_graph, num_cars):
+    def __init__(self, dual_graph, num_cars, router="alt", cache_size=None, cache_file=None):
         self.BASE_SPEED = 5.0
         self.TOP_SPEED = 15.0
 
+        # How cars find their routes: "alt" (landmark A*) or "ch" (contraction hierarchy).
+        if router not in ROUTERS:
+            raise ValueError("unknown router %s, expected one of %s" % (router, ", ".join(ROUTERS)))
+        self.router = router
+
+        # Routes shared by all cars, warm started from cache_file if given. Random trips hardly ever repeat within a
+        # run, so by default there is only a cache (of ROUTE_CACHE_SIZE routes) with a file to keep it in between runs.
+        if cache_size is None:
+            cache_size = ROUTE_CACHE_SIZE if cache_file is not None else 0
+        self.route_cache = RouteCache(cache_size, cache_file, dual_graph.csr.digest()) if cache_size else None
 
-        # A dictionary of car counts for every street
-        self.car_counts = defaultdict(lambda: 0.0)
 
         # self.city_roads
         # self.possible_endpoints
         self.initialize(dual_graph, num_cars)
 
-        self.cumulative_car_data = Counter()
         self.traffic_video_data = []
 
 
@@ -32,9 +44,25 @@ class TrafficSimulator(object):
         """
         self.city_roads = graph
 
-        max_length = sorted(self.city_roads.street_weights.values())[len(self.city_roads.street_weights) / 2]
-        self.possible_endpoints = [node.GetId() for node in self.city_roads.graph.Nodes()
-                                   if self.city_roads.street_weights[node.GetId()] < max_length]
+        # Per street tables, indexed directly by street nid (dual nids are dense, from 1). Plain lists, since cars
+        # read them one street at a time from python, where a list beats both a dict and a numpy array.
+        streets = max(self.city_roads.street_weights) + 1
+        self.street_weights = [1] * streets
+        for nid, weight in self.city_roads.street_weights.iteritems():
+            self.street_weights[nid] = weight
+        # 0.25 ** (1 / weight): each car already on a street multiplies its traffic coefficient by this.
+        self.street_decay = [math.pow(0.25, 1.0 / weight) for weight in self.street_weights]
+
+        # The number of cars on every street, and the traffic coefficient that count gives. Kept up to date by
+        # move_car, and by DualGraphCar.tick, which does the same inline.
+        self.car_counts = [0] * streets
+        self.street_coefficients = [1.0 / decay for decay in self.street_decay]
+
+        # The snapshots taken so far, added up: # cars seen on every street, by street nid.
+        self.street_car_data = np.zeros(streets, dtype=np.int64)
+
+        # Streets shorter than the median, computed (and cached) with the dual graph.
+        self.possible_endpoints = list(self.city_roads.possible_endpoints)
 
         self.setup_simulation(cars)
 
@@ -45,9 +73,27 @@ class TrafficSimulator(object):
         :param street_nid: the street we want a coeff for.
         :return: floating-point number
         """
-        count = self.car_counts[street_nid]
-        # float(count)-1 should never be less than 0; only streets with a car on them call this function.
-        return math.pow(0.25, (float(count)-1) / self.city_roads.street_weights[street_nid])
+        # count-1 should never be less than 0; only streets with a car on them call this.
+        return self.street_coefficients[street_nid]
+
+    def move_car(self, from_street, to_street):
+        """
+        Update the car counts, and the traffic coefficients of the two streets, for one car changing streets.
+        DualGraphCar.tick has the same lines inline: a car moves every few ticks, and the call would cost more than
+        the update.
+        :param from_street: the street the car leaves, None for a new car.
+        :param to_street: the street it enters.
+        :return: None
+        """
+        counts, coefficients, decay = self.car_counts, self.street_coefficients, self.street_decay
+        if from_street is not None:
+            counts[from_street] -= 1
+            if counts[from_street]:
+                coefficients[from_street] /= decay[from_street]
+            else:  # an empty street starts over from the exact value, so rounding never builds up
+                coefficients[from_street] = 1.0 / decay[from_street]
+        counts[to_street] += 1
+        coefficients[to_street] *= decay[to_street]
 
     def setup_simulation(self, N):
         """
@@ -63,11 +109,13 @@ class TrafficSimulator(object):
             self.cars.append(c)
             # print [self.city_roads.street_coordinates[i] for i in c._itinerary]
 
-    def run_simulation(self, max_ticks, frame_rate, type='data'):
+    def run_simulation(self, max_ticks, frame_rate, type='data', sink=None):
         """
         Runs the simulation for max_ticks time steps, taking a picture every frame_rate steps.
         :param max_ticks: some #
         :param frame_rate: some #
+        :param sink: for type 'video', a frames.FrameWriter to stream the pictures to instead of keeping them in
+        self.traffic_video_data.
         :return: None
         """
         for i in xrange(max_ticks):
@@ -78,7 +126,10 @@ class TrafficSimulator(object):
                 if type == 'data':
                     self.add_snapshot()
                 elif type == 'video':
-                    self.traffic_video_data.append(self.take_snapshot())
+                    if sink is not None:
+                        sink.write(*self.street_snapshot())
+                    else:
+                        self.traffic_video_data.append(self.take_snapshot())
 
 
     def tick(self):
@@ -89,28 +140,111 @@ class TrafficSimulator(object):
             # % (car.itinerary_tracking_index, len(car._itinerary))
 
 
+    def street_histogram(self):
+        """
+        The current car distribution, one bincount over the streets the cars are on.
+        :return: # cars on every street, by street nid
+        """
+        streets = np.fromiter((car.street for car in self.cars), dtype=np.int64, count=len(self.cars))
+        return np.bincount(streets, minlength=len(self.street_car_data))
+
+    @property
+    def cumulative_car_data(self):
+        """
+        The snapshots taken so far with coordinates attached, as in .tsd files.
+        :return: a counter of how many cars were seen on each street coordinate
+        """
+        streets = np.flatnonzero(self.street_car_data)
+        return street_counter(streets, self.street_car_data[streets], self.city_roads.street_coordinates)
+
     def add_snapshot(self):
         """
         Taking a picture of the current car distribution.
-        :return: a counter of how many cars are on each street coordinate
         """
-        for car in self.cars:
-            self.cumulative_car_data[car.position] += 1
-        # used for debugging:
-        #return car_data
+        self.street_car_data += self.street_histogram()
 
     def take_snapshot(self):
         """
         Same thing as above but returns 1 snapshot instead of adding snapshot to cumulative data.
+        :return: a counter of how many cars are on each street coordinate
         """
-        picture = Counter()
-        for car in self.cars:
-            picture[car.position] += 1
-        return picture
+        streets, counts = self.street_snapshot()
+        return street_counter(streets, counts, self.city_roads.street_coordinates)
+
+    def street_snapshot(self):
+        """
+        :return: (street nids, # cars on each), for the streets with cars on them
+        """
+        counts = self.street_histogram()
+        streets = np.flatnonzero(counts)
+        return streets, counts[streets]
+
+
+def benchmark_car_counts(dual_graph, moves=1000000, cars=3500, seed=0):
+    """
+    Time the old dict of car counts against the street tables of TrafficSimulator, replaying the same moves among
+    the same background cars. Cars read their street's traffic coefficient every tick, and change streets only
+    once every few ticks, so both are timed. Moves are timed inline, as DualGraphCar.tick makes them.
+    :return: {"dict": (read, move), "tables": (read, move)} seconds per traffic coefficient read and per car move
+    """
+    rng = random.Random(seed)
+    streets = dual_graph.street_weights.keys()
+    background = [rng.choice(streets) for _ in xrange(cars)]
+    path = [rng.choice(streets) for _ in xrange(moves + 1)]
+    weights = dual_graph.street_weights
+
+    counts = defaultdict(lambda: 0.0)
+    for street in background:
+        counts[street] = counts[street] + 1
+
+    start = time.time()
+    for street in background:
+        math.pow(0.25, (float(counts[street]) - 1) / weights[street])
+    dict_read = (time.time() - start) / cars
+
+    counts[path[0]] = counts[path[0]] + 1
+    start = time.time()
+    for i in xrange(moves):
+        current_street, next_street = path[i], path[i + 1]
+        counts[current_street] = counts[current_street] - 1
+        if counts[current_street] == 0:
+            del counts[current_street]
+        counts[next_street] = counts[next_street] + 1
+    dict_move = (time.time() - start) / moves
+
+    tables = TrafficSimulator(dual_graph, 0, cache_size=0)
+    for street in background:
+        tables.move_car(None, street)
+
+    start = time.time()
+    for street in background:
+        tables.traffic_coefficient(street)
+    table_read = (time.time() - start) / cars
+
+    tables.move_car(None, path[0])
+    counts, coefficients, decay = tables.car_counts, tables.street_coefficients, tables.street_decay
+    start = time.time()
+    for i in xrange(moves):
+        current_street, next_street = path[i], path[i + 1]
+        counts[current_street] -= 1
+        if counts[current_street]:
+            coefficients[current_street] /= decay[current_street]
+        else:
+            coefficients[current_street] = 1.0 / decay[current_street]
+        counts[next_street] += 1
+        coefficients[next_street] *= decay[next_street]
+    table_move = (time.time() - start) / moves
+
+    return {"dict": (dict_read, dict_move), "tables": (table_read, table_move)}
 
 
 if __name__ == "__main__":
 
+    if len(sys.argv) == 3 and sys.argv[1] == "benchmark":
+        for path, (read, move) in sorted(benchmark_car_counts(DualGraph(sys.argv[2])).iteritems()):
+            print "%s: %.3f us per traffic coefficient, %.3f us per car move" % (path, read * 1e6, move * 1e6)
+        quit()
+
     TYPE = 'video'
 
 
@@ -120,8 +254,18 @@ if __name__ == "__main__":
     for city in cities:
         print "starting the city of", city
         dg = DualGraph(city)
-        tsim = TrafficSimulator(dg, num_cars=3500)
-        tsim.run_simulation(10000, 20, type=TYPE) # 25 fps, 40 seconds of gif
+        # the same trips on every run, so that the routes saved by the last run are all this one needs
+        random.seed(0)
+        tsim = TrafficSimulator(dg, num_cars=3500, cache_file="../data/" + city + ".routes")
+
+        # Video frames go to ../data/city.tvf as they are taken; `python frames.py tvd city` makes the old .tvd.
+        sink = FrameWriter("../data/" + city + ".tvf") if TYPE == 'video' else None
+        tsim.run_simulation(10000, 20, type=TYPE, sink=sink) # 25 fps, 40 seconds of gif
+        if sink is not None:
+            sink.close()
+
+        print tsim.route_cache.report()
+        tsim.route_cache.save()
 
         print "pickling", city
 
@@ -129,10 +273,6 @@ if __name__ == "__main__":
             output = open("../data/" + city + '.tsd', 'w')
             pickle.dump(tsim.cumulative_car_data, output, 1)
 
-        elif TYPE == 'video':
-            output = open("../data/" + city + '.tvd', 'w')
-            pickle.dump(tsim.traffic_video_data, output, 1)
-
-            print "done"
+        print "done"
 
 
@@ -1,241 +1,519 @@
 import snap
 import random
-import Queue
 import heapq
+import math
+import os
+import time
+import multiprocessing
+import functools
+import numpy as np
 import osmParser
+import csrGraph
+import spatialIndex
 
-C = 5
+# approxCloseness takes N / K pivots unless told otherwise
 K = 100
-N = 1000
-NUM_SAMPLES = N / K
-
-def getEdgeLength(node1, node2, nodesMap):
-	lat1, lon1 = nodesMap[node1]
-	lat2, lon2 = nodesMap[node2]
-
-	return ((lat1 - lat2) ** 2 + (lon1 - lon2) ** 2) ** 0.5
-
-def getDeltas(graph, node, nodesMap):
-	shortestPath = {} # map from (node1, node2) to shortest path length between the two nodes
-	numShortestPaths = {}
-	nodesList = {} # map from nodeId to list of BFS traversal
-
-	s = node
-
-	queue = Queue.Queue()
-	queue.put((None, s, 0))
-	shortestPath[(s, s)] = 0
-
-	nodesList[s] = []
-
-	parents = {}
-	children = {}
-
-	while not queue.empty():
-		prev, v, length = queue.get()
-
-		# Add to the ordering in which we do BFS
-		nodesList[s].append(v)
-
-		# Add previous node to v's parent set
-		if v not in parents:
-			parents[v] = set()
-		if prev is not None:
-			parents[v].add(prev)
-
-		# Set up children set
-		if v not in children:
-			children[v] = set()
-
-		# Add all unvisited or equal length shortest path neighboring nodes to queue
-		currNode = graph.GetNI(v)
-		for index in range(currNode.GetDeg()):
-			neighbor = currNode.GetNbrNId(index)
-			edgeLength = getEdgeLength(v, neighbor, nodesMap)
-			if (s, neighbor) not in shortestPath or shortestPath[(s, neighbor)] == length + edgeLength:
-				queue.put((v, neighbor, length + edgeLength))
-				shortestPath[(s, neighbor)] = length + edgeLength
-				children[v].add(neighbor)
-
-	# populate numShortestPaths
-	for v in nodesList[s]:
-		if v == s:
-			numShortestPaths[(s, v)] = 1
+# number of spatial strata approxCloseness spreads its pivots over
+APPROX_STRATA = 64
+
+# default accuracy of algorithm2: the TOP_EDGES most central edges all within EPSILON of their estimates, relative to
+# them, with probability 1 - DELTA. On Accra that stops at 2048 of 6422 sources with the top 100 off by at most 1.3%.
+EPSILON = 0.2
+DELTA = 0.1
+TOP_EDGES = 100
+# number of sources algorithm2 first checks its stopping rule at, then at every doubling
+FIRST_CHECK = 16
+
+# urbanness ignores nodes closer than this, per metric (0.005 degrees of latitude is about 556 metres)
+URBAN_MIN_DISTANCE = {"degrees": 0.005, "metres": 556.0}
+# urbanness searches stop at the URBAN_NODES-th node, which is not counted (the old limit=500)
+URBAN_NODES = 500
+# sources per unit of work in parallel urbanness
+URBAN_CHUNK = 256
+
+INFINITY = float("inf")
+
+# sources per unit of work in parallel betweenness
+BETWEENNESS_CHUNK = 64
+
+# sources per multi-source BFS in bfsCloseness
+CLOSENESS_BATCH = 1024
+
+# the graph parallel betweenness, urbanness and closeness workers read, set just before the pool forks
+_sharedGraph = None
+
+def _forkedMap(graph, func, chunks, workers):
+	"""
+	Generates func(graph, chunk) for every chunk, in order. With workers > 1 the chunks go to a process pool forked
+	with graph in _sharedGraph, so the workers see it without pickling and share the numpy arrays' pages. func must
+	be a module level function (or a functools.partial of one) so that it can be sent to them.
+	"""
+	if workers == 1:
+		for chunk in chunks:
+			yield func(graph, chunk)
+		return
+
+	global _sharedGraph
+	_sharedGraph = graph
+	pool = multiprocessing.Pool(workers)
+	try:
+		for result in pool.imap(_forkedCall, [(func, chunk) for chunk in chunks]):
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+		_sharedGraph = None
+
+def _forkedCall(args):
+	func, chunk = args
+	return func(_sharedGraph, chunk)
+
+# CSRGraph with edge lengths in the given metric ("degrees", "metres" or "hops"), computed once per graph
+def weightedGraph(graph, nodesMap, metric="degrees"):
+	graph = csrGraph.asCSR(graph, nodesMap)
+	if graph.weights is None or graph.metric != metric:
+		graph.setEdgeLengths(metric)
+	return graph
+
+"""
+Brandes' betweenness on a weighted CSRGraph, one source at a time: a Dijkstra phase that counts shortest paths
+(sigma) and records the settling order, then dependencies accumulated in reverse order over both nodes and edges.
+The scratch arrays are allocated once and only the entries a source touched are reset.
+"""
+class Brandes(object):
+
+	def __init__(self, graph):
+		self.graph = graph
+		arcEdge, self.edgeEnds = csrGraph.edgeIds(graph)
+		self.arcEdge = arcEdge.tolist()
+
+		n = graph.GetNodes()
+		self.dist = [INFINITY] * n
+		self.sigma = [0] * n
+		self.delta = [0.0] * n
+		self.settled = [False] * n
+		self.position = [0] * n # index in the settling order
+		self.edgeDelta = [0.0] * len(self.edgeEnds)
+
+		self.order = []
+		self.edges = []
+
+	def run(self, s):
+		"""
+		Dependencies of source index s. Returns (order, edges): the settled nodes, whose dependency is in self.delta,
+		and the ids of the edges on the shortest path DAG, whose dependency is in self.edgeDelta. Both hold until
+		the next run.
+		"""
+		indptr, indices, weights = self.graph.lists()
+		arcEdge = self.arcEdge
+		dist, sigma, delta, settled, edgeDelta = self.dist, self.sigma, self.delta, self.settled, self.edgeDelta
+		position = self.position
+
+		for v in self.order:
+			dist[v] = INFINITY
+			sigma[v] = 0
+			delta[v] = 0.0
+			settled[v] = False
+		for e in self.edges:
+			edgeDelta[e] = 0.0
+
+		order = []
+		edges = []
+		dist[s] = 0.0
+		sigma[s] = 1
+		heap = [(0.0, 0, s)]
+		pushes = 1 # ties are settled first in, first out, so zero length edges keep their order
+
+		while heap:
+			d, _, v = heapq.heappop(heap)
+			if settled[v] or d > dist[v]:
+				continue
+			settled[v] = True
+			position[v] = len(order)
+			order.append(v)
+
+			for k in xrange(indptr[v], indptr[v + 1]):
+				w = indices[k]
+				if settled[w]:
+					continue
+				nd = d + weights[k]
+				if nd < dist[w]:
+					dist[w] = nd
+					sigma[w] = sigma[v]
+					heapq.heappush(heap, (nd, pushes, w))
+					pushes += 1
+				elif nd == dist[w]:
+					sigma[w] += sigma[v]
+
+		for w in reversed(order):
+			coefficient = (1.0 + delta[w]) / sigma[w]
+			for k in xrange(indptr[w], indptr[w + 1]):
+				v = indices[k]
+				# v is a parent of w. Across a zero length edge only the end settled first is, as in the sigma counts.
+				if dist[v] + weights[k] == dist[w] and position[v] < position[w]:
+					contribution = sigma[v] * coefficient
+					delta[v] += contribution
+					edgeDelta[arcEdge[k]] += contribution
+					edges.append(arcEdge[k])
+
+		self.order = order
+		self.edges = edges
+		return order, edges
+
+def betweenness(graph, nodesMap, sources=None, metric="degrees", workers=1, samples=None, seed=None):
+	"""
+	Weighted node and edge betweenness, as dicts keyed by node id and by (id1, id2) with id1 <= id2, on the same
+	scale as snap.GetBetweennessCentr (with metric="hops" the values are equal). With sources (indices), or a
+	number of samples drawn with the given seed, only those sources are accumulated and the result is scaled up to
+	estimate the full value.
+
+	workers > 1 splits the sources across a process pool. Sources are always accumulated in the same chunks and
+	the partial vectors summed in chunk order, so the result doesn't depend on the number of workers.
+	"""
+	graph = weightedGraph(graph, nodesMap, metric)
+	n = graph.GetNodes()
+	if sources is None:
+		if samples is None:
+			sources = xrange(n)
 		else:
-			total = sum([numShortestPaths[s, neighbor] for neighbor in parents[v]])
-			numShortestPaths[(s, v)] = total
-			
-	# calculate dependencies
-	dependency = {}
-	for w in reversed(nodesList[s]):
-		setV = {} # map from valid v to o_sv
-		for parent in parents[w]:
-			if shortestPath[(s, w)] > shortestPath[(s, parent)]:
-				setV[parent] = numShortestPaths[(s, parent)] / float(numShortestPaths[(s, w)])
-			if shortestPath[(s, w)] == shortestPath[(s, parent)]:
-				dependency[tuple(sorted((parent, w)))] = 0
-
-		for v in setV:
-			dependency[tuple(sorted((v, w)))] = setV[v] # set to o_sv / o_sw
-
-		if len(children[w]) != 0: # not a leaf
-			total = 1
-			for x in children[w]:
-				total += dependency[tuple(sorted((x, w)))]
-
-			for v in setV:
-				dependency[tuple(sorted((v, w)))] *= total
-
-	return dependency
-
-def algorithm2(graph, nodesMap):
-	allDependencies = {}
-	numK = {}
-	shortestPath = {} # map from (node1, node2) to shortest path length between the two nodes
-	numShortestPaths = {}
-	nodesList = {} # map from nodeId to list of BFS traversal
-
-	for edge in graph.Edges():
-		start = edge.GetSrcNId()
-		end = edge.GetDstNId()
-
-		tup = tuple(sorted((start, end)))
-		allDependencies[tup] = 0
-		numK[tup] = 0
-
-	for _ in xrange(graph.GetNodes() / K):
-		s = graph.GetRndNId()
-
-		dependency = getDeltas(graph, s, nodesMap)
-
-		for edge in dependency:
-			if allDependencies[edge] < C * N:
-				allDependencies[edge] += dependency[edge]
-				numK[edge] += 1
-
-		canBreak = True
-		for edge in allDependencies:
-			if allDependencies[edge] < C * N:
-				canBreak = False
-				break
-			if numK[edge] < NUM_SAMPLES:
-				canBreak = False
+			sources = random.Random(seed).sample(xrange(n), samples)
+	sources = list(sources)
+	chunks = [sources[i:i + BETWEENNESS_CHUNK] for i in xrange(0, len(sources), BETWEENNESS_CHUNK)]
+
+	nodeBetween = np.zeros(n)
+	edgeBetween = np.zeros(len(csrGraph.edgeIds(graph)[1])) # numbered here, once, before any worker forks
+	for nodePartial, edgePartial in _forkedMap(graph, _accumulateBetweenness, chunks, workers):
+		nodeBetween += nodePartial
+		edgeBetween += edgePartial
+
+	scale = float(n) / max(len(sources), 1)
+	return _betweennessResults(graph, nodeBetween.tolist(), edgeBetween.tolist(), scale)
+
+# Node betweenness by snap.GetBetweennessCentr from a random fraction of the sources, as a dict keyed by node id.
+# Sums over the sampled sources only, not scaled up like betweenness.
+def snapBetweenness(graph, fraction):
+	nodeToBetweenness = snap.TIntFltH()
+	edgeToBetweenness = snap.TIntPrFltH()
+	snap.GetBetweennessCentr(graph, nodeToBetweenness, edgeToBetweenness, fraction)
+
+	betweenness = {}
+	for node in nodeToBetweenness:
+		betweenness[node] = nodeToBetweenness[node]
+	return betweenness
+
+# partial dependency vectors (node, edge) of a list of sources
+def _accumulateBetweenness(graph, sources):
+	brandes = Brandes(graph)
+	nodeBetween = [0.0] * graph.GetNodes()
+	edgeBetween = [0.0] * len(brandes.edgeEnds)
+
+	for s in sources:
+		order, edges = brandes.run(s)
+		for v in order:
+			if v != s:
+				nodeBetween[v] += brandes.delta[v]
+		for e in edges:
+			edgeBetween[e] += brandes.edgeDelta[e]
+
+	return np.array(nodeBetween), np.array(edgeBetween)
+
+# node and edge accumulators, by index, to dicts keyed by snap ids. Nodes are halved since every path is seen
+# from both ends, edges are not, as in snap.
+def _betweennessResults(graph, nodeBetween, edgeBetween, scale):
+	ids = graph.idList()
+	edgeEnds = csrGraph.edgeIds(graph)[1]
+	nodeResults = {}
+	for v in xrange(len(nodeBetween)):
+		nodeResults[ids[v]] = nodeBetween[v] * scale / 2
+
+	edgeResults = {}
+	for e, (a, b) in enumerate(edgeEnds.tolist()):
+		edgeResults[(ids[a], ids[b])] = edgeBetween[e] * scale
+
+	return nodeResults, edgeResults
+
+"""
+Adaptive sampling estimate of weighted edge betweenness (snap's scale, see betweenness).
+
+Sources are drawn without replacement in a seeded random order. For each edge we keep the sum and sum of squares of
+its dependency, normalized by n - 1 to [0, 1]. At k = FIRST_CHECK, 2 * FIRST_CHECK, 4 * FIRST_CHECK... sources
+we stop once the topEdges edges with the largest estimates are all within epsilon of their estimates, relative to
+them, with probability 1 - delta, union bounded over those edges and the checks. The bounds are normal
+approximations with the finite population correction, so they shrink to nothing as k reaches n, where the values
+are exact. An additive bound can't do this: most edges have tiny betweenness, and the constant term of a
+Bernstein bound keeps it wider than any useful epsilon until nearly every source is sampled.
+
+Returns (estimates, intervals, number of sources), where intervals maps each edge to a (low, high) interval that
+holds with probability 1 - delta on its own.
+"""
+def algorithm2(graph, nodesMap, metric="degrees", epsilon=EPSILON, delta=DELTA, topEdges=TOP_EDGES, seed=None):
+	graph = weightedGraph(graph, nodesMap, metric)
+	brandes = Brandes(graph)
+	ids = graph.idList()
+	n = graph.GetNodes()
+
+	numEdges = len(brandes.edgeEnds)
+	sums = [0.0] * numEdges
+	squares = [0.0] * numEdges
+
+	sources = random.Random(seed).sample(xrange(n), n)
+	nextCheck = FIRST_CHECK
+	checks = 0
+
+	k = 0
+	while k < n:
+		_, edges = brandes.run(sources[k])
+		k += 1
+
+		for edge in edges:
+			x = brandes.edgeDelta[edge] / (n - 1.0)
+			sums[edge] += x
+			squares[edge] += x * x
+
+		if k == nextCheck: # only at doubling sample sizes, so checking costs O(1) per source overall
+			checks += 1
+			nextCheck *= 2
+			means = np.array(sums) / k
+			top = np.argsort(means)[::-1][:topEdges]
+			top = top[means[top] > 0]
+			if len(top) == 0:
+				continue
+			widths = _normalWidths(np.array(sums)[top], np.array(squares)[top], k, n, delta / (2 ** checks * len(top)))
+			if (widths / means[top]).max() <= epsilon:
 				break
-		if canBreak: break
-
-	removed = set()
-	for edge in allDependencies:
-		if numK[edge] == 0:
-			removed.add(edge)
-		else:
-			allDependencies[edge] = allDependencies[edge] * N / float(numK[edge])
-
-	for edge in removed:
-		del allDependencies[edge]
-
-	return allDependencies
 
-def analyzeCity(city):
+	widths = _normalWidths(sums, squares, k, n, delta)
+
+	# back to snap node ids; ids are sorted, so (start, end) stays ordered
+	scale = n * (n - 1.0)
+	estimates = {}
+	intervals = {}
+	for edge, (start, end) in enumerate(brandes.edgeEnds.tolist()):
+		mean = sums[edge] / k
+		key = (ids[start], ids[end])
+		estimates[key] = mean * scale
+		intervals[key] = (max(mean - widths[edge], 0.0) * scale, (mean + widths[edge]) * scale)
+
+	return estimates, intervals, k
+
+# Two sided half widths, holding with probability 1 - delta each under a normal approximation, of the means of k of
+# the n sources' samples, per edge. inf below 2 samples, where there is no variance to go on.
+def _normalWidths(sums, squares, k, n, delta):
+	sums = np.array(sums)
+	if k < 2:
+		return np.repeat(np.inf, len(sums))
+	mean = sums / k
+	variance = np.maximum(np.array(squares) - sums * mean, 0.0) / (k - 1)
+	return np.sqrt(2 * math.log(2.0 / delta) * variance / k * (n - k) / (n - 1.0))
+
+def analyzeCity(city, epsilon=EPSILON, delta=DELTA, seed=None):
 	graph, nodesMap = osmParser.simpleLoadFromFile(city)
-	return algorithm2(graph, nodesMap), nodesMap
+	estimates, intervals, numSources = algorithm2(graph, nodesMap, epsilon=epsilon, delta=delta, seed=seed)
+	print "sampled", numSources, "of", graph.GetNodes(), "sources"
+	return estimates, intervals, nodesMap
 
-def dijkstrasDistance(graph, nodesMap, node, limit=None):
-	queue = Queue.PriorityQueue()
-	seen = set()
-	minDistances = {}
-
-	queue.put((0, node))
-
-	count = 0
-
-	while not queue.empty():
-		priority, n = queue.get()
-
-		if n in seen:
-			continue
-		seen.add(n)
-		count += 1
-		if limit is not None:
-			if count >= limit:
-				break
-
-		minDistances[n] = priority
-		currNode = graph.GetNI(n)
-
-		for index in range(currNode.GetDeg()):
-			neighbor = currNode.GetNbrNId(index)
-
-			if neighbor in seen:
-				continue
-
-			cost = getEdgeLength(n, neighbor, nodesMap)
-			queue.put((cost + priority, neighbor))
-
-	return minDistances
+# graph is a weighted CSRGraph and node an index into it. Returns a map from index to distance.
+# limit stops the search when the limit-th node is reached, without recording it.
+def dijkstrasDistance(graph, node, limit=None):
+	return csrGraph.dijkstra(graph, node, maxNodes=limit - 1 if limit is not None else None)
 
 # adapted from https://networkx.github.io/documentation/development/_modules/networkx/algorithms/centrality/closeness.html
-def closenessCentrality(graph, nodesMap, normalized=True):
+def closenessCentrality(graph, nodesMap, normalized=True, metric="degrees"):
+	graph = weightedGraph(graph, nodesMap, metric)
+	ids = graph.idList()
+
 	closeness_centrality = {}
-	for node in graph.Nodes():
-		n = node.GetId()
-		sp = dijkstrasDistance(graph, nodesMap, n)
+	for n in xrange(graph.GetNodes()):
+		nid = ids[n]
+		sp = dijkstrasDistance(graph, n)
 		totsp = sum(sp.values())
 
 		if totsp > 0.0 and graph.GetNodes() > 1:
-			closeness_centrality[n] = (len(sp) - 1.0) / totsp
+			closeness_centrality[nid] = (len(sp) - 1.0) / totsp
 			if normalized:
 				s = (len(sp)-1.0) / (graph.GetNodes() - 1)
-				closeness_centrality[n] *= s
+				closeness_centrality[nid] *= s
 		else:
-			closeness_centrality[n] = 0.0
+			closeness_centrality[nid] = 0.0
 
 	return closeness_centrality
 
-def approxCloseness(graph, nodesMap):
-	allDistances = {}
-	sampled = set()
-
-	# take N / K samples
-	for _ in xrange(graph.GetNodes() / K):
-		# pick new random node
-		n = graph.GetRndNId()
-		while n in sampled:
-			n = graph.GetRndNId()
-		sampled.add(n)
-
-		sp = dijkstrasDistance(graph, nodesMap, n)
+"""
+Exact unweighted closeness of every node, equal to snap.GetClosenessCentr: (reached - 1) / sum of hop distances,
+times (reached - 1) / (n - 1).
+Sources go through csrGraph.multiSourceBFS CLOSENESS_BATCH at a time, split across workers processes, and since
+the graph is undirected each node's distance sum is accumulated from the batches it is reached in.
+
+With a checkpoint path, the accumulated sums and finished batches are saved after every batch and picked up again
+by a later call of the same graph (see CSRGraph.digest); the file is removed once every batch is done.
+"""
+def bfsCloseness(graph, nodesMap=None, workers=1, checkpoint=None):
+	graph = csrGraph.asCSR(graph, nodesMap)
+	n = graph.GetNodes()
+	batches = [(b, xrange(i, min(i + CLOSENESS_BATCH, n))) for b, i in enumerate(xrange(0, n, CLOSENESS_BATCH))]
+
+	farness = np.zeros(n, dtype=np.int64)
+	reached = np.zeros(n, dtype=np.int64)
+	done = np.zeros(len(batches), dtype=bool)
+	digest = graph.digest()
+	if checkpoint is not None and os.path.isfile(checkpoint):
+		saved = np.load(checkpoint)
+		if 'digest' in saved.files and str(saved['digest']) == digest and len(saved['done']) == len(batches):
+			farness, reached, done = saved['farness'], saved['reached'], saved['done']
+			print "resuming closeness,", done.sum(), "of", len(batches), "batches done"
+
+	todo = [batch for batch in batches if not done[batch[0]]]
+	start = time.time()
+
+	for count, (b, batchFarness, batchReached) in enumerate(_forkedMap(graph, _closenessBatch, todo, workers)):
+		farness += batchFarness
+		reached += batchReached
+		done[b] = True
+
+		if checkpoint is not None:
+			temporary = checkpoint + ".tmp"
+			with open(temporary, 'wb') as out:
+				np.savez(out, farness=farness, reached=reached, done=done, digest=np.array(digest))
+			os.rename(temporary, checkpoint)
+
+		elapsed = time.time() - start
+		print "closeness batch %d / %d, %.0fs elapsed, %.0fs to go" % \
+			(done.sum(), len(batches), elapsed, elapsed / (count + 1) * (len(todo) - count - 1))
+
+	if checkpoint is not None and os.path.isfile(checkpoint):
+		os.remove(checkpoint)
+
+	# scaled by the share of the graph reached, as snap does, which only matters on disconnected graphs
+	closeness = np.where(farness > 0, (reached - 1.0) / np.maximum(farness, 1), 0.0) * (reached - 1.0) / max(n - 1, 1)
+	return dict(zip(graph.idList(), closeness.tolist()))
+
+def _closenessBatch(graph, batch):
+	b, sources = batch
+	batchFarness, batchReached = csrGraph.multiSourceBFS(graph, list(sources))
+	return b, batchFarness, batchReached
+
+"""
+Approximate closeness from the distances to a sample of pivots. Every node keeps a running sum, sum of squares
+and count of its distances to the pivots that reach it, so the estimate is one over the mean distance to the
+pivots and its standard error follows from the sample variance (with the finite population correction, and the
+delta method for the inverse).
+
+Pivots are a permutation of the nodes, taken in order. With spread, and node coordinates, every prefix of it
+draws from the cells of a spatial grid in proportion to their sizes, so pivots cover the whole city. Stratifying
+only makes the estimate less variable, so the simple random sampling error it reports is conservative.
+
+Takes samples pivots, N / K by default. With targetError it stops instead, at a doubling sample size, once no
+node's standard error is more than targetError of its closeness. Returns (closeness, standard errors, pivots used),
+the dicts keyed by node id.
+"""
+def approxCloseness(graph, nodesMap, metric="degrees", samples=None, targetError=None, spread=True, seed=None):
+	graph = weightedGraph(graph, nodesMap, metric)
+	ids = graph.idList()
+	n = graph.GetNodes()
+	pivots = _pivotOrder(graph, spread, seed)
+
+	sums = np.zeros(n)
+	squares = np.zeros(n)
+	counts = np.zeros(n, dtype=np.int64)
+
+	if samples is None:
+		samples = n if targetError is not None else max(n / K, 1)
+	samples = min(samples, n)
+	nextCheck = FIRST_CHECK
+
+	k = 0
+	while k < samples:
+		pivot = pivots[k]
+		sp = csrGraph.dijkstra(graph, pivot)
+		k += 1
+
+		reached = np.fromiter(sp.iterkeys(), dtype=np.int64, count=len(sp))
+		distances = np.fromiter(sp.itervalues(), dtype=np.float64, count=len(sp))
+		sums[reached] += distances
+		squares[reached] += distances * distances
+		counts[reached] += 1
+		counts[pivot] -= 1 # a pivot is not its own sample
+
+		if targetError is not None and k == nextCheck:
+			nextCheck *= 2
+			closeness, errors = _closenessErrors(sums, squares, counts, n)
+			checked = np.isfinite(errors)
+			if checked.any() and (errors[checked] / closeness[checked]).max() <= targetError:
+				break
 
-		allDistances[n] = list(sp.values())
-		# for each node, store distance from node n to that node in map
-		for nid in sp:
-			if not nid in allDistances:
-				allDistances[nid] = []
-			allDistances[nid].append(sp[nid])
+	closeness, errors = _closenessErrors(sums, squares, counts, n)
+	estimated = np.flatnonzero(closeness > 0).tolist()
+	results = dict((ids[v], closeness[v]) for v in estimated)
+	standardErrors = dict((ids[v], errors[v]) for v in estimated)
+
+	return results, standardErrors, k
+
+# Pivot order for approxCloseness: a random permutation, or a stratified one over a grid of the node coordinates
+def _pivotOrder(graph, spread, seed):
+	rng = np.random.RandomState(seed)
+	n = graph.GetNodes()
+	if not spread or graph.coords is None:
+		return rng.permutation(n).tolist()
+
+	cells = spatialIndex.GridIndex(graph.coords, pointsPerCell=max(n / APPROX_STRATA, 1)).cellOf()
+	shuffled = rng.permutation(n)
+	shuffled = shuffled[np.argsort(cells[shuffled], kind='mergesort')]
+	cells = cells[shuffled]
+	sizes = np.bincount(cells)
+	rank = np.arange(n) - (np.cumsum(sizes) - sizes)[cells]
+
+	# a node's (jittered) position within its cell as a fraction of the cell, so cells interleave by size
+	return shuffled[np.argsort((rank + rng.random_sample(n)) / sizes[cells])].tolist()
+
+# closeness (one over the mean pivot distance) and its standard error per node, 0 and inf where there is no estimate
+def _closenessErrors(sums, squares, counts, n):
+	closeness = np.zeros(n)
+	errors = np.empty(n)
+	errors.fill(INFINITY)
+
+	valid = sums > 0
+	closeness[valid] = counts[valid] / sums[valid]
+
+	sampled = valid & (counts >= 2)
+	c = counts[sampled].astype(np.float64)
+	mean = sums[sampled] / c
+	variance = np.maximum(squares[sampled] - sums[sampled] * mean, 0.0) / (c - 1)
+	errors[sampled] = np.sqrt(variance / c * np.maximum(1.0 - c / (n - 1.0), 0.0)) / (mean * mean)
+	return closeness, errors
+
+"""
+For every node, the inverse of the average distance to the nodes reached by a search bounded to URBAN_NODES nodes,
+ignoring those closer than URBAN_MIN_DISTANCE. Sources are split across workers processes like betweenness.
+"""
+def urbanness(graph, nodesMap, normalized=True, metric="degrees", workers=1):
+	graph = weightedGraph(graph, nodesMap, metric)
+	ids = graph.idList()
+	n = graph.GetNodes()
+	chunks = [xrange(i, min(i + URBAN_CHUNK, n)) for i in xrange(0, n, URBAN_CHUNK)]
 
-	# inverse of the average distance to other nodes
 	results = {}
-	for nid in allDistances:
-		total = sum(allDistances[nid])
-		results[nid] = len(allDistances[nid]) / float(total)
+	for partial in _forkedMap(graph, functools.partial(_urbannessChunk, metric=metric), chunks, workers):
+		for v, value in partial:
+			results[ids[v]] = value
 
 	return results
 
-def urbanness(graph, nodesMap, normalized=True):
-	results = {}
-	for node in graph.Nodes():
-		nid = node.GetId()
+# (index, urbanness) for the sources that have any node far enough away
+def _urbannessChunk(graph, sources, metric):
+	search = csrGraph.BoundedSearch(graph)
+	minDistance = URBAN_MIN_DISTANCE[metric]
 
-		sp = dijkstrasDistance(graph, nodesMap, nid, limit=500)
+	values = []
+	for s in sources:
 		totsp = 0
 		count = 0
-		for value in sp:
-			if sp[value] > 0.005:
-				totsp += sp[value]
+		for d in search.run(s, maxNodes=URBAN_NODES - 1):
+			if d > minDistance:
+				totsp += d
 				count += 1
 		if count == 0:
 			continue
 
-		results[nid] = count / float(totsp)
-
-	return results
+		values.append((s, count / float(totsp)))
 
+	return values